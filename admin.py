@@ -12,6 +12,10 @@ class ProductAdmin(admin.ModelAdmin):
     list_filter = ['exchanges']
     filter_horizontal = ['exchanges']
 
+    def queryset(self, request):
+        # ex and subex are resolved from prefetched exchanges
+        return super(ProductAdmin, self).queryset(request).with_refs()
+
 
 admin.site.register(Exchange, ExchangeAdmin)
 
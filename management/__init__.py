@@ -2,11 +2,25 @@ from os.path import basename, dirname
 
 from south.signals import post_migrate
 
-from corpdb.utils.initdb import init_db
+APP = basename(dirname(dirname(__file__)))
+
+
+def needs_init():
+    """
+    Cheap check whether any initial data is missing: one EXISTS query per
+    table, no loader imported.
+    """
+    from corpdb.models import Country, District, Exchange, Product, Sector
+
+    return not all(m.objects.exists()
+                   for m in (Country, District, Exchange, Product, Sector))
 
 
 def migration_callback(**kwargs):
-    if kwargs['app'] == basename(dirname(dirname(__file__))):
+    if kwargs['app'] == APP and needs_init():
+        # the loaders, and pandas on a cold sector cache, load only here
+        from corpdb.utils.initdb import init_db
+
         init_db()
 
 
@@ -0,0 +1,163 @@
+import json
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from corpdb.models import Product, OHLC_MODELS
+
+PATHS = ('init', 'single', 'update', 'ex')
+
+
+class Command(BaseCommand):
+    help = ('Benchmark init_db, update_single, updateprice and Product.ex() '
+            'on a throwaway test database, downloading from a local fake '
+            'yahoo server.')
+    option_list = BaseCommand.option_list + (
+        make_option('--products', '-n',
+                    type='int',
+                    action='store',
+                    dest='products',
+                    default=200,
+                    help='Products to seed. Default is 200.'),
+        make_option('--latency',
+                    type='float',
+                    action='store',
+                    dest='latency',
+                    default=0.01,
+                    help='Seconds the fake server waits per request. Default is 0.01.'),
+        make_option('--error-rate',
+                    type='float',
+                    action='store',
+                    dest='error_rate',
+                    default=0,
+                    help='Share of requests answered with a 503. Default is 0.'),
+        make_option('--history',
+                    type='int',
+                    action='store',
+                    dest='history',
+                    default=250,
+                    help='Daily bars served per symbol. Default is 250.'),
+        make_option('--workers', '-w',
+                    type='int',
+                    action='store',
+                    dest='workers',
+                    default=4,
+                    help='Concurrent downloads of the update path. Default is 4.'),
+        make_option('--paths',
+                    action='store',
+                    dest='paths',
+                    default=','.join(PATHS),
+                    help='Comma separated paths to run. Default is %s.' % ','.join(PATHS)),
+        make_option('--memory',
+                    action='store_true',
+                    dest='memory',
+                    default=False,
+                    help='Run each path a second time with tracemalloc on '
+                         'for its peak memory. The timed run is never traced.'),
+        make_option('--output', '-o',
+                    action='store',
+                    dest='output',
+                    default=None,
+                    help='Also write the results as json to this file.'),
+    )
+
+    def handle(self, *args, **options):
+        logging.getLogger('corpdb.config').debug(options)
+        paths = options['paths'].split(',')
+        for path in paths:
+            if path not in PATHS:
+                raise ValueError('Unknown path "%s", choose from %s'
+                                 % (path, ', '.join(PATHS)))
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = run(paths, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write('%-8s %8s %10s %8s %10s %12s %8s %10s' % (
+            'path', 'symbols', 'bars', 'seconds', 'symbols/s', 'bars/s',
+            'queries', 'peak MiB'))
+        for r in results:
+            peak = '%.1f' % (r['peak'] / 2.0 ** 20) if r['peak'] is not None else '-'
+            self.stdout.write('%-8s %8d %10d %8.2f %10.1f %12.1f %8d %10s' % (
+                r['name'], r['symbols'], r['bars'], r['seconds'],
+                r['symbols_per_sec'], r['bars_per_sec'], r['queries'], peak))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'options': dict((k, options[k]) for k in (
+                    'products', 'latency', 'error_rate', 'history', 'workers',
+                    'memory')),
+                    'results': results}, f, indent=2)
+
+
+def run(paths, options):
+    from corpdb.management.commands.updateprice import (
+        update_list, update_single, NETWORK_ERRORS)
+    from corpdb.utils import benchmark as bm
+    from corpdb.utils.pricesource import YahooSource
+
+    def bench(setup, func, *args, **kwargs):
+        """
+        Time func after setup and, with --memory, trace it in a second
+        run from the same state.
+        """
+        setup()
+        result, stats = bm.measure(func, *args, **kwargs)
+        if options['memory']:
+            setup()
+            result, stats['peak'] = bm.peak_memory(func, *args, **kwargs)
+        return result, stats
+
+    results = []
+    if 'init' in paths:
+        from corpdb.utils.initdb import init_db
+
+        _, stats = bench(bm.clear_reference, init_db)
+        results.append(bm.report('init', stats, symbols=Product.objects.count()))
+
+    server = bm.FakeYahooServer(latency=options['latency'],
+                                error_rate=options['error_rate'],
+                                history=options['history']).start()
+    try:
+        source = YahooSource(host=server.host)
+        products = bm.seed_products(options['products'])
+        ohlc = OHLC_MODELS['d'].objects.filter(product__in=products)
+
+        if 'single' in paths:
+            def single():
+                for p in products:
+                    p.last_update = None
+                    try:
+                        update_single(p, 'd', source=source)
+                    except NETWORK_ERRORS:
+                        pass
+
+            _, stats = bench(lambda: bm.reset_prices(products), single)
+            results.append(bm.report('single', stats, symbols=len(products),
+                                     bars=ohlc.count()))
+
+        if 'update' in paths:
+            def reset():
+                bm.reset_prices(products)
+                for p in products:
+                    p.last_update = None
+
+            _, stats = bench(reset, update_list, list(products), 'd', retry=3,
+                             loop_after=1, workers=options['workers'],
+                             source=source)
+            results.append(bm.report('update', stats, symbols=len(products),
+                                     bars=ohlc.count()))
+    finally:
+        server.stop()
+
+    if 'ex' in paths:
+        def ex():
+            return [(p.ex(), p.subex()) for p in Product.objects.with_refs()]
+
+        pairs, stats = bench(lambda: None, ex)
+        results.append(bm.report('ex', stats, symbols=len(pairs)))
+    return results
@@ -0,0 +1,32 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from corpdb.models import OHLC_MODELS
+
+OHLCKlass = OHLC_MODELS
+
+
+class Command(BaseCommand):
+    args = '[root]'
+    help = ('Export ohlc data to one numpy file per product and period under '
+            'root, default is the CORPDB_COLUMNAR_ROOT setting.')
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--period',
+                    action='store',
+                    dest='period',
+                    default='mwd',
+                    help=('You can choose d for daily, w for weekly and '
+                          'm for monthly data, or any combination, like dwm.'
+                          'Default is mwd')
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        from corpdb.utils.columnar import export_ohlc
+
+        logging.getLogger('corpdb.config').debug(options)
+        root = args[0] if args else None
+        for p in options['period']:
+            export_ohlc(OHLCKlass[p], p, root=root)
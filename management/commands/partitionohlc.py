@@ -0,0 +1,78 @@
+import logging
+from datetime import date
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from corpdb.models import OHLC_MODELS
+
+OHLCKlass = OHLC_MODELS
+
+
+class Command(BaseCommand):
+    help = ('Maintain yearly range partitions and covering indexes of the '
+            'ohlc tables on PostgreSQL 12 or later. Without options, only '
+            'creates the partitions of the coming years.')
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--period',
+                    action='store',
+                    dest='period',
+                    default='d',
+                    help=('You can choose d for daily, w for weekly and '
+                          'm for monthly data, or any combination, like dwm.'
+                          'Default is d')
+                    ),
+        make_option('--partition',
+                    action='store_true',
+                    dest='partition',
+                    default=False,
+                    help=('Convert unpartitioned tables, copying all their '
+                          'rows. Locks the tables while it runs.')
+                    ),
+        make_option('--ahead',
+                    type='int',
+                    action='store',
+                    dest='ahead',
+                    default=1,
+                    help='Years after the current one to create partitions for. Default is 1.'
+                    ),
+        make_option('--drop-before',
+                    type='int',
+                    action='store',
+                    dest='drop_before',
+                    default=None,
+                    help='Drop the partitions, and bars, of years before this one.'
+                    ),
+        make_option('--index',
+                    action='store_true',
+                    dest='index',
+                    default=False,
+                    help='Create the (date, product) index including close and adj_close.'
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        from corpdb.utils import partition
+
+        logging.getLogger('corpdb.config').debug(options)
+        last = date.today().year + options['ahead']
+        for p in options['period']:
+            klass = OHLCKlass[p]
+            if options['partition']:
+                partition.partition_table(klass, ahead=options['ahead'])
+            if partition.is_partitioned(klass):
+                years = partition.partition_years(klass)
+                created = partition.create_partitions(
+                    klass, years[-1] + 1 if years else date.today().year, last)
+                if created:
+                    self.stdout.write('%s: created partitions %s.'
+                                      % (klass._meta.db_table, created))
+                if options['drop_before']:
+                    dropped = partition.drop_partitions(klass, options['drop_before'])
+                    self.stdout.write('%s: dropped partitions %s.'
+                                      % (klass._meta.db_table, dropped))
+            elif options['drop_before']:
+                raise ValueError('%s is not partitioned, run with --partition first.'
+                                 % klass._meta.db_table)
+            if options['index']:
+                partition.create_covering_index(klass)
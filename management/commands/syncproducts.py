@@ -0,0 +1,44 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from corpdb.utils.listing import sz_listing, nasdaq_listing, sync_listing, data_file
+from corpdb.utils.refcache import registry
+
+
+def nasdaq_records():
+    for sub_ex in ('CM', 'GM', 'GS'):
+        for rec in nasdaq_listing(data_file('nasdaq-%s.csv' % sub_ex.lower()), sub_ex):
+            yield rec
+
+
+LISTINGS = {'SZSE': sz_listing,
+            'NASDAQ': nasdaq_records,
+            }
+
+
+class Command(BaseCommand):
+    help = ('Apply changes in the exchange listing files of data/ to the '
+            'products: new listings, changed rows and delistings.')
+    option_list = BaseCommand.option_list + (
+        make_option('--exchange', '-e',
+                    action='store',
+                    dest='exchange',
+                    default='SZSE,NASDAQ',
+                    help='Comma separated exchanges. Default is SZSE,NASDAQ'),
+        make_option('--dry-run',
+                    action='store_true',
+                    dest='dry_run',
+                    default=False,
+                    help='Only report the number of changes.'),
+    )
+
+    def handle(self, *args, **options):
+        logging.getLogger('corpdb.config').debug(options)
+        for symbol in options['exchange'].split(','):
+            stats = sync_listing(list(LISTINGS[symbol]()),
+                                 registry.exchange(symbol),
+                                 dry_run=options['dry_run'])
+            self.stdout.write('%s: %d inserted, %d updated, %d delisted.' % (
+                symbol, stats['inserted'], stats['updated'], stats['delisted']))
@@ -1,27 +1,32 @@
+import zlib
 import logging
-import csv
 import time
-import socket
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import timedelta, date
 from optparse import make_option
-from urllib.error import URLError
 
 from django.core.management.base import BaseCommand
-from django.db.models import Max
-from django.db.models import Q
-from django.db import transaction
+from django.db import connection, transaction, IntegrityError
 
-from corpdb.models import Product
-from corpdb.models import OhlcD, OhlcW, OhlcM
-from corpdb.utils.pullprice import pull_price
+from corpdb.models import Product, OhlcStatus, UpdateJobItem
+from corpdb.models import OHLC_MODELS
+from corpdb.utils import pullprice
+from corpdb.utils import jobs
+from corpdb.utils import partition
+from corpdb.utils.codec import EncodeError
+from corpdb.utils.metrics import metrics
+from corpdb.utils.pricesource import get_source, SOURCE_ERRORS, SourceError
+from corpdb.utils.respcache import ResponseCache, TTL, MAX_BYTES
+from corpdb.utils.retry import Backoff, CircuitBreaker, RetryQueue
+from corpdb.utils.saveprice import save_bars, upsert_bars, BATCH_SIZE
+from corpdb.utils.saveprice import touch_status, rebuild_status, seed_status
 
 
 logger = logging.getLogger(__name__)
 
-OHLCKlass = {'d': OhlcD,
-             'w': OhlcW,
-             'm': OhlcM,
-             }
+OHLCKlass = OHLC_MODELS
+
+NETWORK_ERRORS = SOURCE_ERRORS
 
 
 class Command(BaseCommand):
@@ -47,14 +52,211 @@ class Command(BaseCommand):
                     help=('Update if last trader date is earlier than this date.'
                           'Values can be init, TD or a date formated YYYY-MM-DD')
                     ),
+        make_option('--workers', '-w',
+                    type='int',
+                    action='store',
+                    dest='workers',
+                    default=1,
+                    help=('Number of concurrent downloads. Database writes '
+                          'always happen on a single writer. Default is 1.')
+                    ),
+        make_option('--rate',
+                    type='float',
+                    action='store',
+                    dest='rate',
+                    default=0,
+                    help=('Max requests per second sent to one host, '
+                          '0 for no limit. Default is 0.')
+                    ),
+        make_option('--batch-size',
+                    type='int',
+                    action='store',
+                    dest='batch_size',
+                    default=BATCH_SIZE,
+                    help='Records per INSERT statement. Default is %d.' % BATCH_SIZE
+                    ),
+        make_option('--upsert',
+                    action='store_true',
+                    dest='upsert',
+                    default=False,
+                    help=('Overwrite records of existing dates instead of '
+                          'inserting duplicates. Use it when reruns overlap.')
+                    ),
+        make_option('--rebuild-status',
+                    action='store_true',
+                    dest='rebuild_status',
+                    default=False,
+                    help=('Recompute the last update dates from the ohlc '
+                          'tables before updating. Needed once on databases '
+                          'loaded before ohlc_status existed.')
+                    ),
+        make_option('--source',
+                    action='store',
+                    dest='source',
+                    default='yahoo',
+                    help=('Where to get prices: yahoo, yahoo:host[:port] for '
+                          'another server of the same API, or a directory or '
+                          'tarball of <period>/<symbol>.csv files. '
+                          'Default is yahoo.')
+                    ),
+        make_option('--resample',
+                    action='store_true',
+                    dest='resample',
+                    default=False,
+                    help=('Build weekly and monthly data from the daily data '
+                          'instead of downloading them.')
+                    ),
+        make_option('--shard',
+                    action='store',
+                    dest='shard',
+                    default=None,
+                    help=('Only update products of shard i out of N, given as '
+                          'i/N, e.g. 0/4. Shards split products by a hash of '
+                          'their symbols, so N hosts can share a run.')
+                    ),
+        make_option('--exchange', '-e',
+                    action='store',
+                    dest='exchange',
+                    default=None,
+                    help='Only update products listed on this exchange, e.g. SZSE.'
+                    ),
+        make_option('--parallel-periods',
+                    action='store_true',
+                    dest='parallel',
+                    default=False,
+                    help='Update the periods concurrently instead of one by one.'
+                    ),
+        make_option('--resume',
+                    action='store_true',
+                    dest='resume',
+                    default=False,
+                    help=('Continue the last unfinished run of the same periods, '
+                          'shard and exchange, skipping the products it '
+                          'already updated.')
+                    ),
+        make_option('--cache-dir',
+                    action='store',
+                    dest='cache_dir',
+                    default=None,
+                    help=('Keep downloaded responses in this directory and '
+                          'reuse or revalidate them on later requests.')
+                    ),
+        make_option('--cache-ttl',
+                    type='int',
+                    action='store',
+                    dest='cache_ttl',
+                    default=TTL,
+                    help=('Seconds a cached response is used without asking '
+                          'the server. Default is %d.' % TTL)
+                    ),
+        make_option('--cache-size',
+                    type='int',
+                    action='store',
+                    dest='cache_size',
+                    default=MAX_BYTES // 2 ** 20,
+                    help=('Size of the response cache in MiB. '
+                          'Default is %d.' % (MAX_BYTES // 2 ** 20))
+                    ),
+        make_option('--metrics-file',
+                    action='store',
+                    dest='metrics_file',
+                    default=None,
+                    help=('Write the run metrics to this file, in the '
+                          'Prometheus text format if it ends with .prom, '
+                          'as json otherwise.')
+                    ),
     )
 
     def handle(self, *args, **options):
         logging.getLogger('corpdb.config').debug(options)
-        update(period=options['period'], retry=options['retry'], ld=options['ld'])
+        pullprice.rate_limiter.rate = options['rate']
+        metrics.reset()
+        cache = None
+        if options['cache_dir']:
+            cache = ResponseCache(options['cache_dir'], ttl=options['cache_ttl'],
+                                  max_bytes=options['cache_size'] * 2 ** 20)
+        try:
+            if options['rebuild_status']:
+                for p in options['period']:
+                    rebuild_status(OHLCKlass[p], p)
+            update(period=options['period'], retry=options['retry'], ld=options['ld'],
+                   workers=options['workers'], batch_size=options['batch_size'],
+                   upsert=options['upsert'], source=get_source(options['source'], cache=cache),
+                   resample=options['resample'], shard=parse_shard(options['shard']),
+                   exchange=options['exchange'], parallel=options['parallel'],
+                   resume=options['resume'])
+        finally:
+            # also after a crash, to see where it spent its time
+            logger.info('Run summary:\n%s', metrics.summary())
+            if options['metrics_file']:
+                metrics.write(options['metrics_file'])
+
+
+def parse_shard(value):
+    """
+    '1/4' -> (1, 4). None stays None.
+    """
+    if not value:
+        return None
+    try:
+        i, n = map(int, value.split('/'))
+    except ValueError:
+        raise ValueError('Shard values error. Set shard like 0/4. Got "%s"' % value)
+    if not 0 <= i < n:
+        raise ValueError('Shard index must be in [0, %d). Got "%s"' % (n, value))
+    return i, n
+
+
+def in_shard(symbol, shard):
+    # crc32 is stable across processes and hosts, unlike hash()
+    return shard is None or \
+        zlib.crc32(symbol.encode('utf-8')) % shard[1] == shard[0]
+
+
+def select_products(exchange=None):
+    """
+    Listed products of `exchange` (a top level exchange symbol), all
+    exchanges by default. Shards are applied by in_shard on the results.
+    """
+    products = Product.objects.filter(delisted=False)
+    if exchange:
+        products = products.filter(exchanges__symbol=exchange,
+                                   exchanges__parent=None)
+    return products
+
+
+def last_trade_date(period, ld):
+    """
+    The date of the latest `period` bar expected to be available on `ld`.
+    """
+    # get last trading day
+    if period == 'd':
+        # yahoo historical prices are usually delayed
+        ld = ld - timedelta(4)
+        # last weekday
+        # today=Sat.: -1 to get Friday,
+        # today=Sun.: -2 to get Friday,
+        return ld - timedelta({6: 1, 7: 2}.get(
+            ld.isoweekday(), 0))
+
+    elif period == 'w':
+        # Monday of last full week
+        # Get last Monday
+        last_trade = ld - timedelta(ld.weekday())
+        # Find last last Monday for possible delays
+        return last_trade - timedelta(7)
 
+    elif period == 'm':
+        # Get first day of last month
+        return (ld.replace(day=1) - timedelta(1)).replace(day=1)
 
-def update(period='dwm', retry=6, retry_wait=60 * 2, ld='TD'):
+    else:
+        raise Exception
+
+
+def update(period='dwm', retry=6, retry_wait=60 * 2, ld='TD', workers=1,
+           batch_size=BATCH_SIZE, upsert=False, source=None, resample=False,
+           shard=None, exchange=None, parallel=False, resume=False):
     if ld == 'init':
         ld = date(1992, 1, 1)
     elif ld == 'TD':
@@ -64,117 +266,322 @@ def update(period='dwm', retry=6, retry_wait=60 * 2, ld='TD'):
             ld = date(*map(int, ld.split('-')))
         except:
             raise ValueError('Date values error. Set date like 1992-01-15. Got "%s"' % ld)
+    options = dict(retry=retry, loop_after=retry_wait, workers=workers,
+                   batch_size=batch_size, upsert=upsert, source=source)
+    # a partitioned table takes no bars of a year without a partition
     for p in period:
-        # get last trading day
-        if p == 'd':
-            # yahoo historical prices are usually delayed
-            ld = ld - timedelta(4)
-            # last weekday
-            # today=Sat.: -1 to get Friday,
-            # today=Sun.: -2 to get Friday,
-            last_trade = ld - timedelta({6: 1, 7: 2}.get(
-                ld.isoweekday(), 0))
-
-        elif p == 'w':
-            # Monday of last full week
-            # Get last Monday
-            last_trade = ld - timedelta(ld.weekday())
-            # Find last last Monday for possible delays
-            last_trade = last_trade - timedelta(7)
-
-        elif p == 'm':
-            # Get first day of last month
-            last_trade = (ld.replace(day=1) - timedelta(1)).replace(day=1)
+        partition.ensure_partitions(OHLCKlass[p])
 
+    def run(p):
+        update_period(p, ld, resample=resample, shard=shard,
+                      exchange=exchange, resume=resume, **options)
+
+    # weekly and monthly data built locally need fresh daily data first
+    stages = [[p for p in period if not (resample and p in 'wm')],
+              [p for p in period if resample and p in 'wm']]
+    for stage in stages:
+        if parallel and len(stage) > 1:
+            run_parallel(run, stage)
         else:
-            raise Exception
+            for p in stage:
+                run(p)
 
-        stocks = Product.objects.annotate(last_update=Max('ohlc' + p + '__date'))
-        stocks = stocks.filter(
-            Q(last_update=None) | Q(last_update__lt=last_trade)
-        )
 
-        update_list(stocks=stocks, period=p,
-                    retry=retry, loop_after=retry_wait)
+def run_parallel(func, periods):
+    """
+    Call func(p) for each period on its own thread, and its own database
+    connection. Exceptions are raised once all threads finished.
+    """
+    def target(p):
+        try:
+            return func(p)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=len(periods)) as executor:
+        futures = [executor.submit(target, p) for p in periods]
+    for future in futures:
+        future.result()
+
+
+def update_period(period, ld, resample=False, shard=None, exchange=None,
+                  resume=False, **options):
+    if resample and period in 'wm':
+        from corpdb.utils import resample as rs
+
+        products = rs.stale_products(period)
+        if shard or exchange:
+            allowed = set(pk for pk, symbol in
+                          select_products(exchange=exchange)
+                          .values_list('pk', 'symbol')
+                          if in_shard(symbol, shard))
+            products = dict((pk, d) for pk, d in products.items() if pk in allowed)
+        rs.resample(OHLCKlass[period], period, products=products,
+                    batch_size=options.get('batch_size', BATCH_SIZE))
+        return
+
+    shard_str = '%d/%d' % shard if shard else ''
+    job = jobs.find_job(period, shard_str, exchange) if resume else None
+    if job is not None:
+        # the products left are known, no need to recompute the stale set
+        stocks = with_marks(period, Product.objects.filter(
+            pk__in=jobs.outstanding(job)))
+        logger.info('Resume %s update started %s: %d products left.'
+                    % (period, job.started, len(stocks)))
+    else:
+        last_trade = last_trade_date(period, ld)
+        stocks = stale_products(period, last_trade,
+                                shard=shard, exchange=exchange)
+        job = jobs.start_job(period, last_trade, stocks,
+                             shard=shard_str, exchange=exchange)
+    update_list(stocks=stocks, period=period, job=job, **options)
+
+
+def stale_products(period, last_trade, shard=None, exchange=None):
+    """
+    Products without `period` bars on or after `last_trade`, with their
+    watermark as `last_update`. Reads ohlc_status, and the ohlc table
+    only for products with bars but no watermark yet, see seed_status.
+    `shard` and `exchange` limit the products as in select_products.
+    """
+    seed_status(OHLCKlass[period], period)
+    fresh = OhlcStatus.objects.filter(period=period,
+                                      last_date__gte=last_trade).values('product')
+    stocks = select_products(exchange=exchange).exclude(pk__in=fresh)
+    return with_marks(period, [p for p in stocks if in_shard(p.symbol, shard)])
+
+
+def with_marks(period, products):
+    """
+    List `products` with their `period` watermark as `last_update`.
+    """
+    marks = dict(OhlcStatus.objects.filter(period=period)
+                 .values_list('product', 'last_date'))
+    stocks = list(products)
+    for p in stocks:
+        p.last_update = marks.get(p.pk)
+    return stocks
 
 
-def update_list(stocks, period, retry=3, loop_after=60 * 2):
+def update_list(stocks, period, retry=3, loop_after=60 * 2, workers=1,
+                batch_size=BATCH_SIZE, upsert=False, source=None, job=None):
     """
     update ohlc_%period automatically
+
+    Downloads run on up to `workers` threads, while records are written
+    to the database by the calling thread only. A failed symbol gets up
+    to `retry` attempts with jittered exponential backoff capped at
+    `loop_after` seconds, and the other symbols keep going meanwhile.
+    Many failures in a row pause all downloads for `loop_after` seconds.
+
+    The outcome of each product is recorded in the UpdateJob `job`, if
+    given, so an interrupted run can be resumed.
     """
-    retry -= 1
-    pre_str = '(%d atts) ' % retry
     len_stock = len(stocks)
 
     if len_stock == 0:
+        if job is not None:
+            jobs.finish_job(job)
         logger.info('Finished update with no fails!')
         return True
-    if retry < 0:
-        logger.warning('Finished %s data update with %d fails' % (
-                        period, len_stock))
-        logger.error('Failed to insert symbols: %s %s',period, ' '.join([p.symbol for p in stocks]) )
-        return False
-
-    fails = []
-    cur = 0
 
+    queue = RetryQueue()
     for p in stocks:
-        cur += 1
         if not p.last_update:
             p.last_update = date(1991, 1, 1)
+        queue.push(p)
+    backoff = Backoff(cap=loop_after)
+    breaker = CircuitBreaker(cooldown=loop_after)
+
+    fails = []
+    cur = 0
 
+    for p, attempts, bars in fetch_list(queue, period, breaker,
+                                        workers=workers, source=source):
+        pre_str = '(%d atts) ' % (attempts + 1)
         try:
-            state = update_single(p, period=period)
-        except (URLError, ConnectionResetError, socket.timeout):
+            if isinstance(bars, NETWORK_ERRORS):
+                raise bars
+            state = write_single(p, period=period, bars=bars,
+                                 batch_size=batch_size, upsert=upsert,
+                                 job=job, attempts=attempts + 1)
+        except SourceError as e:
+            # a retry would not find it either, and it says nothing
+            # about the health of the source
+            touch_status(p, period, error=str(e))
+            if job is not None:
+                jobs.mark_item(job, p, UpdateJobItem.FAILED, attempts + 1, str(e))
+            cur += 1
             fails.append(p)
-            logger.warning(pre_str + '%-6s %s download from %s failed.(%d/%d)' % (
-                p.symbol, period, p.last_update, cur, len_stock))
-            time.sleep(3)
-        except Exception as e:
+            metrics.inc('symbols_failed')
+            logger.warning('%s%-6s %s not in source: %s.(%d/%d)',
+                           pre_str, p.symbol, period, e, cur, len_stock)
+        except EncodeError as e:
+            # write_single rolled back, the bars of this symbol do not
+            # fit the table; the others still may
+            touch_status(p, period, error=str(e))
+            if job is not None:
+                jobs.mark_item(job, p, UpdateJobItem.FAILED, attempts + 1, str(e))
+            cur += 1
+            fails.append(p)
+            metrics.inc('symbols_failed')
+            logger.error('%s%-6s %s bars cannot be stored: %s.(%d/%d)',
+                         pre_str, p.symbol, period, e, cur, len_stock)
+        except IntegrityError as e:
+            # rolled back as well: the source sent bars already stored
+            touch_status(p, period, error=str(e))
+            if job is not None:
+                jobs.mark_item(job, p, UpdateJobItem.FAILED, attempts + 1, str(e))
+            cur += 1
             fails.append(p)
+            metrics.inc('symbols_failed')
+            logger.error('%s%-6s %s bars from %s overlap stored ones, '
+                         'run with --upsert: %s.(%d/%d)', pre_str, p.symbol,
+                         period, p.last_update, e, cur, len_stock)
+        except NETWORK_ERRORS as e:
+            touch_status(p, period, error=str(e))
+            metrics.inc('download_errors')
+            if job is not None:
+                jobs.mark_item(job, p, UpdateJobItem.PENDING if attempts + 1 < retry
+                               else UpdateJobItem.FAILED, attempts + 1, str(e))
+            if breaker.failure():
+                metrics.inc('breaker_trips')
+                logger.warning('%d %s downloads failed in a row. Pause %d sec.',
+                               breaker.threshold, period, breaker.cooldown)
+            if attempts + 1 < retry:
+                delay = backoff.delay(attempts)
+                queue.push(p, delay, attempts + 1)
+                metrics.inc('retries')
+                logger.warning('%s%-6s %s download from %s failed. '
+                               'Retry %d sec later.(%d/%d)', pre_str,
+                               p.symbol, period, p.last_update, delay,
+                               cur, len_stock)
+            else:
+                cur += 1
+                fails.append(p)
+                metrics.inc('symbols_failed')
+                logger.warning('%s%-6s %s download from %s failed.(%d/%d)',
+                               pre_str, p.symbol, period, p.last_update,
+                               cur, len_stock)
+        except Exception as e:
             logger.critical('Unknown Exception')
             logger.critical(str(e.__class__) + str(e))
             raise e
         else:
-            logger.info(pre_str + '%-6s %4s %s records from %s inserted.(%d/%d)'
-                        % (p.symbol, state, period,
-                           p.last_update, cur, len_stock))
+            cur += 1
+            breaker.success()
+            metrics.inc('symbols_updated')
+            logger.info('%s%-6s %4s %s records from %s inserted.(%d/%d)',
+                        pre_str, p.symbol, state, period,
+                        p.last_update, cur, len_stock)
 
-    if retry > 0:
-        logger.info(pre_str +
-                    'Current loop end. %d %s fails. Retry %d sec later.' %
-                    (len(fails), period, loop_after))
-        time.sleep(loop_after)
+    if job is not None:
+        jobs.finish_job(job, failed=bool(fails))
+    if fails:
+        logger.warning('Finished %s data update with %d fails' % (
+                        period, len(fails)))
+        logger.error('Failed to insert symbols: %s %s', period, ' '.join([p.symbol for p in fails]))
+        return False
+
+    logger.info('Finished update with no fails!')
+    return True
 
-    update_list(stocks=fails,
-                period=period,
-                retry=retry,
-                loop_after=loop_after,
-                )
+
+def fetch_single(product, period, source=None):
+    """
+    Return a lazy iterator of parsed bars streaming from `source`,
+    yahoo by default.
+    """
+    source = source or get_source()
+    return source.bars(symbol=product.symbol + product.yahoo_sfx,
+                       startd=product.last_update,
+                       period=period)
+
+
+def _fetch(product, period, stream=False, source=None):
+    try:
+        bars = fetch_single(product, period, source=source)
+        # worker threads read the whole body, the writer streams it itself
+        if stream:
+            return bars
+        with metrics.timer('fetch_seconds'):
+            return list(bars)
+    except NETWORK_ERRORS as e:
+        return e
+
+
+def fetch_list(queue, period, breaker, workers=1, source=None):
+    """
+    Yield (product, attempts, bars) as downloads of the products in the
+    RetryQueue `queue` complete, each one once it is due and while
+    `breaker` is closed. On network failures bars is the exception
+    instead. The caller may push products back into `queue` meanwhile.
+
+    With a single worker bars are parsed straight from the response
+    while they are written. Otherwise up to `workers` downloads are in
+    flight and a parsed one waits for the writer.
+    """
+    if workers <= 1:
+        while queue:
+            time.sleep(max(queue.wait_time(), breaker.wait_time()))
+            p, attempts = queue.pop()
+            metrics.set('queue_depth', len(queue))
+            yield p, attempts, _fetch(p, period, stream=True, source=source)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        while queue or pending:
+            while len(pending) < workers and queue.ready() and breaker.closed():
+                p, attempts = queue.pop()
+                future = executor.submit(_fetch, p, period, source=source)
+                pending[future] = (p, attempts)
+            metrics.set('queue_depth', len(queue))
+            metrics.set('in_flight', len(pending))
+
+            timeout = None
+            if queue and len(pending) < workers:
+                timeout = max(queue.wait_time(), breaker.wait_time())
+            if not pending:
+                time.sleep(timeout)
+                continue
+
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                p, attempts = pending.pop(future)
+                yield p, attempts, future.result()
+
+
+def update_single(product, period, batch_size=BATCH_SIZE, upsert=False,
+                  source=None):
+    return write_single(product, period,
+                        fetch_single(product, period, source=source),
+                        batch_size=batch_size, upsert=upsert)
+
+
+def _track_newest(bars, newest):
+    for b in bars:
+        if newest[0] is None or b[0] > newest[0]:
+            newest[0] = b[0]
+        yield b
 
 
 @transaction.commit_on_success
-def update_single(product, period):
-    r = pull_price(symbol=product.symbol + product.yahoo_sfx,
-                   startd=product.last_update,
-                   period=period)
-    r = r.strip().splitlines()
-    r = r[2:-1]  # remove header, latest and last data(data on date_from).
-    r.reverse()  # put older data ahead
-    reader = csv.DictReader(r, fieldnames=[
-        'Date', 'Open', 'High', 'Low',
-        'Close', 'Volume', 'Adj Close'])
-
-    for rec in reader:
-        OHLCKlass[period](
-            product=product,
-            date=rec['Date'],
-            open=rec['Open'],
-            high=rec['High'],
-            low=rec['Low'],
-            close=rec['Close'],
-            volume=rec['Volume'],
-            adj_close=rec['Adj Close']
-        ).save()
-
-    return reader.line_num
+def write_single(product, period, bars, batch_size=BATCH_SIZE, upsert=False,
+                 job=None, attempts=1):
+    """
+    Write `bars` as yielded by parse_price, and move the watermark to the
+    newest of them. The item of `product` in `job` is marked done in the
+    same transaction.
+    """
+    newest = [None]
+    save = upsert_bars if upsert else save_bars
+    # while streaming, this includes reading the response
+    with metrics.timer('write_seconds'):
+        count = save(OHLCKlass[period], product, _track_newest(bars, newest),
+                     batch_size=batch_size)
+        touch_status(product, period, last_date=newest[0])
+    metrics.inc('bars_inserted', count)
+    if job is not None:
+        jobs.mark_item(job, product, UpdateJobItem.DONE, attempts)
+    return count
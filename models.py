@@ -1,8 +1,11 @@
 from __future__ import unicode_literals
 
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
 from django.utils.encoding import python_2_unicode_compatible
 
+from corpdb.utils.codec import FLOAT, SCALED
+
 
 @python_2_unicode_compatible
 class SectorStandard(models.Model):
@@ -17,8 +20,92 @@ class SectorStandard(models.Model):
         db_table = 'sector_standard'
 
 
+class PathTree(models.Model):
+    """
+    Adjacency list with a materialized path: `path` holds the pks from
+    the root down to the node, e.g. '3/17/230/', so a whole subtree is
+    one indexed prefix query. Subclasses define `parent`.
+
+    save() keeps paths current, including the subtree of a moved node.
+    Rows written with bulk_create or update() need rebuild_paths().
+    """
+    path = models.CharField(max_length=255, blank=True, db_index=True)
+
+    class Meta:
+        abstract = True
+
+    def build_path(self):
+        prefix = self.parent.path if self.parent_id else ''
+        return '%s%d/' % (prefix, self.pk)
+
+    def save(self, *args, **kwargs):
+        super(PathTree, self).save(*args, **kwargs)
+        path = self.build_path()
+        if path != self.path:
+            old, self.path = self.path, path
+            super(PathTree, self).save(update_fields=['path'])
+            if old:
+                for node in type(self).objects.filter(path__startswith=old) \
+                        .exclude(pk=self.pk):
+                    node.path = path + node.path[len(old):]
+                    super(PathTree, node).save(update_fields=['path'])
+
+    def descendants(self, include_self=False):
+        nodes = type(self).objects.filter(path__startswith=self.path)
+        if not include_self:
+            nodes = nodes.exclude(pk=self.pk)
+        return nodes
+
+    def ancestors(self):
+        pks = [int(pk) for pk in self.path.split('/')[:-2]]
+        return type(self).objects.filter(pk__in=pks)
+
+    @classmethod
+    def rebuild_paths(cls):
+        """
+        Recompute all paths from the parent links in one pass over the
+        table. The rows that changed are written a tree level at a time,
+        each from the path of its parent, by one UPDATE per level and
+        BATCH_SIZE rows. Returns the number of rows changed.
+        """
+        from corpdb.utils.saveprice import BATCH_SIZE
+
+        nodes = dict((pk, (parent, path)) for pk, parent, path in
+                     cls.objects.values_list('pk', 'parent', 'path'))
+        paths = {}
+
+        def path_of(pk):
+            if pk not in paths:
+                parent = nodes[pk][0]
+                paths[pk] = (path_of(parent) if parent else '') + '%d/' % pk
+            return paths[pk]
+
+        levels = {}
+        for pk, (parent, path) in nodes.items():
+            if path_of(pk) != path:
+                levels.setdefault(paths[pk].count('/'), []).append(pk)
+
+        qn = connection.ops.quote_name
+        meta = cls._meta
+        names = dict(table=qn(meta.db_table), pk=qn(meta.pk.column),
+                     path=qn(meta.get_field('path').column),
+                     parent=qn(meta.get_field('parent').column))
+        sql = ("UPDATE %(table)s SET %(path)s = COALESCE("
+               "(SELECT p.%(path)s FROM %(table)s p WHERE p.%(pk)s = %(table)s.%(parent)s), '')"
+               " || CAST(%(pk)s AS VARCHAR(255)) || '/' WHERE %(pk)s IN (%%s)" % names)
+        cursor = connection.cursor()
+        # parents first, their paths are read by the level below
+        for level in sorted(levels):
+            pks = levels[level]
+            for i in range(0, len(pks), BATCH_SIZE):
+                batch = pks[i:i + BATCH_SIZE]
+                cursor.execute(sql % ', '.join(['%s'] * len(batch)), batch)
+        transaction.commit_unless_managed()
+        return sum(len(pks) for pks in levels.values())
+
+
 @python_2_unicode_compatible
-class Sector(models.Model):
+class Sector(PathTree):
     code = models.CharField(max_length=15, blank=True)
     name = models.CharField(max_length=63, )
     parent = models.ForeignKey('self', null=True, blank=True)
@@ -28,6 +115,13 @@ class Sector(models.Model):
     def __str__(self):
         return self.name
 
+    def products(self):
+        """
+        Products in this sector or any of its sub sectors.
+        """
+        return Product.objects.filter(sectors__path__startswith=self.path) \
+            .distinct()
+
     class Meta:
         db_table = 'sector'
 
@@ -46,7 +140,7 @@ class Country(models.Model):
 
 
 @python_2_unicode_compatible
-class District(models.Model):
+class District(PathTree):
     name = models.CharField(max_length=15, blank=True)
     level = models.IntegerField(null=True, blank=True)
     parent = models.ForeignKey('self', null=True, blank=True)
@@ -56,6 +150,13 @@ class District(models.Model):
     def __str__(self):
         return self.name
 
+    def companies(self):
+        """
+        Companies in this district or any district below it.
+        """
+        return Company.objects.filter(districts__path__startswith=self.path) \
+            .distinct()
+
     class Meta:
         db_table = 'district'
 
@@ -90,6 +191,34 @@ class Exchange(models.Model):
         db_table = 'exchange'
 
 
+def _pick(items, parent_id, model):
+    # in memory version of related.get(parent=...)
+    found = [x for x in items if x.parent_id == parent_id]
+    if not found:
+        raise model.DoesNotExist
+    if len(found) > 1:
+        raise model.MultipleObjectsReturned
+    return found[0]
+
+
+class ProductQuerySet(models.query.QuerySet):
+    def with_refs(self):
+        """
+        Load companies, exchanges and sectors with the products, so ex(),
+        subex(), sector() and subsector() need no further queries.
+        """
+        return self.select_related('company') \
+            .prefetch_related('exchanges', 'sectors')
+
+
+class ProductManager(models.Manager):
+    def get_query_set(self):
+        return ProductQuerySet(self.model, using=self._db)
+
+    def with_refs(self):
+        return self.get_query_set().with_refs()
+
+
 @python_2_unicode_compatible
 class Product(models.Model):
     symbol = models.CharField(max_length=15)
@@ -101,21 +230,30 @@ class Product(models.Model):
     ipo_date = models.CharField(max_length=10, blank=True)
     yahoo_sfx = models.CharField(max_length=5, blank=True)
     note = models.TextField(blank=True)
+    # hash of the exchange listing row, see utils.listing
+    src_hash = models.CharField(max_length=40, blank=True)
+    delisted = models.BooleanField(default=False)
+
+    objects = ProductManager()
 
+    # exchanges.all() and sectors.all() are served from the prefetch
+    # cache of with_refs(), or cost one query otherwise.
     def ex(self):
-        return self.exchanges.get(parent=None)
+        return _pick(self.exchanges.all(), None, Exchange)
 
     def subex(self):
-        return self.exchanges.get(parent=self.ex())
+        exchanges = list(self.exchanges.all())
+        return _pick(exchanges, _pick(exchanges, None, Exchange).pk, Exchange)
 
     ex.short_description = 'Exchange'
     subex.short_description = 'Sub Exchange'
 
     def sector(self):
-        return self.sectors.get(parent=None)
+        return _pick(self.sectors.all(), None, Sector)
 
     def subsector(self):
-        return self.sectors.get(parent=self.ex())
+        sectors = list(self.sectors.all())
+        return _pick(sectors, _pick(sectors, None, Sector).pk, Sector)
 
     sector.short_description = 'Sector'
     subsector.short_description = 'Sub Sector'
@@ -148,14 +286,21 @@ class OHLC(models.Model):
     adj_close = models.FloatField()
     volume = models.BigIntegerField()
 
+    codec = FLOAT
+
     def __str__(self):
         return self.product
 
     class Meta:
         abstract = True
-        index_together = [
+        unique_together = [
             ['product', 'date'],
         ]
+        # cross sections of a date; see utils.partition for a covering
+        # index on PostgreSQL
+        index_together = [
+            ['date', 'product'],
+        ]
 
 
 class OhlcD(OHLC):
@@ -173,3 +318,156 @@ class OhlcM(OHLC):
         db_table = 'ohlc_m'
 
 
+@python_2_unicode_compatible
+class CompactOHLC(models.Model):
+    """
+    OHLC with prices in 1/10000 units and adj_close as a factor of close,
+    see utils.codec. Rows take about a quarter less space.
+    """
+    product = models.ForeignKey(Product)
+    date = models.DateField()
+    open = models.IntegerField()
+    high = models.IntegerField()
+    low = models.IntegerField()
+    close = models.IntegerField()
+    adj_factor = models.BigIntegerField()
+    volume = models.BigIntegerField()
+
+    codec = SCALED
+
+    def __str__(self):
+        return self.product
+
+    class Meta:
+        abstract = True
+        unique_together = [
+            ['product', 'date'],
+        ]
+        index_together = [
+            ['date', 'product'],
+        ]
+
+
+class CompactOhlcD(CompactOHLC):
+    class Meta(CompactOHLC.Meta):
+        db_table = 'ohlc_d_compact'
+
+
+class CompactOhlcW(CompactOHLC):
+    class Meta(CompactOHLC.Meta):
+        db_table = 'ohlc_w_compact'
+
+
+class CompactOhlcM(CompactOHLC):
+    class Meta(CompactOHLC.Meta):
+        db_table = 'ohlc_m_compact'
+
+
+FLOAT_OHLC_MODELS = {'d': OhlcD,
+                     'w': OhlcW,
+                     'm': OhlcM,
+                     }
+COMPACT_OHLC_MODELS = {'d': CompactOhlcD,
+                       'w': CompactOhlcW,
+                       'm': CompactOhlcM,
+                       }
+# the tables loaders and readers use
+OHLC_MODELS = COMPACT_OHLC_MODELS \
+    if getattr(settings, 'CORPDB_COMPACT_OHLC', False) else FLOAT_OHLC_MODELS
+
+
+@python_2_unicode_compatible
+class OhlcStatus(models.Model):
+    """
+    Watermark of the ohlc tables: the newest bar stored for a product and
+    period, and the outcome of the last download attempt.
+    """
+    product = models.ForeignKey(Product)
+    period = models.CharField(max_length=1)
+    last_date = models.DateField(null=True, blank=True)
+    # weekly and monthly data built from daily bars: the newest daily bar
+    # read, see utils.resample
+    source_date = models.DateField(null=True, blank=True)
+    last_attempt = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return '%s %s' % (self.product_id, self.period)
+
+    class Meta:
+        db_table = 'ohlc_status'
+        unique_together = [
+            ['product', 'period'],
+        ]
+        index_together = [
+            ['period', 'last_date'],
+        ]
+
+
+
+@python_2_unicode_compatible
+class UpdateJob(models.Model):
+    """
+    One updateprice run of a period, shard and exchange, over the stale
+    products selected when it started. See corpdb.utils.jobs.
+    """
+    RUNNING, DONE, FAILED = 'running', 'done', 'failed'
+    STATUS_CHOICES = (
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    period = models.CharField(max_length=1)
+    shard = models.CharField(max_length=15, blank=True)
+    exchange = models.CharField(max_length=63, blank=True)
+    last_trade = models.DateField()
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES,
+                              default=RUNNING)
+    started = models.DateTimeField()
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return '%s %s %s' % (self.period, self.started, self.status)
+
+    class Meta:
+        db_table = 'update_job'
+        index_together = [
+            ['period', 'shard', 'exchange'],
+        ]
+
+
+@python_2_unicode_compatible
+class UpdateJobItem(models.Model):
+    """
+    Progress of one product in an UpdateJob.
+    """
+    PENDING, DONE, FAILED = 'pending', 'done', 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    job = models.ForeignKey(UpdateJob, related_name='items')
+    product = models.ForeignKey(Product)
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES,
+                              default=PENDING)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return '%s %s' % (self.product_id, self.status)
+
+    class Meta:
+        db_table = 'update_job_item'
+        unique_together = [
+            ['job', 'product'],
+        ]
+        index_together = [
+            ['job', 'status'],
+        ]
+
+
+# connects the cache invalidation signals of the reference tables
+from corpdb.utils import refcache
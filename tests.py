@@ -4,8 +4,16 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import io
+import gzip
+import threading
+from datetime import date
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, TransactionTestCase
+
+from corpdb.utils.pullprice import parse_price
+from corpdb.utils.resample import aggregate, COLUMNS
 
 
 class SimpleTest(TestCase):
@@ -14,3 +22,766 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+YAHOO_CSV = '''Date,Open,High,Low,Close,Volume,Adj Close
+2013-05-31,10.50,10.80,10.40,10.70,1200,10.70
+2013-05-30,10.20,10.60,10.10,10.50,1100,10.50
+2013-05-29,10.00,10.30,9.90,10.20,1000,10.20
+2013-05-28,9.80,10.10,9.70,10.00,900,10.00
+'''
+
+
+class ParsePriceTest(SimpleTestCase):
+    def test_skips_header_latest_and_oldest(self):
+        bars = list(parse_price(io.BytesIO(YAHOO_CSV.encode())))
+        self.assertEqual([b[0] for b in bars],
+                         [date(2013, 5, 30), date(2013, 5, 29)])
+
+    def test_typed_values(self):
+        bar = next(parse_price(YAHOO_CSV))
+        self.assertEqual(bar, (date(2013, 5, 30), 10.2, 10.6, 10.1, 10.5,
+                               1100, 10.5))
+        self.assertIsInstance(bar[5], int)
+
+    def test_empty_history(self):
+        self.assertEqual(list(parse_price('Date,Open,High,Low,Close,Volume,Adj Close\n')), [])
+
+
+class ShardTest(SimpleTestCase):
+    def test_parse_shard(self):
+        from corpdb.management.commands.updateprice import parse_shard
+        self.assertEqual(parse_shard('1/4'), (1, 4))
+        self.assertIsNone(parse_shard(None))
+        self.assertRaises(ValueError, parse_shard, '4/4')
+        self.assertRaises(ValueError, parse_shard, 'a')
+
+    def test_shards_partition_symbols(self):
+        from corpdb.management.commands.updateprice import in_shard
+        symbols = ['%06d' % i for i in range(100)]
+        shards = [[s for s in symbols if in_shard(s, (i, 3))] for i in range(3)]
+        self.assertEqual(sorted(sum(shards, [])), symbols)
+
+
+class FakeCsvTest(SimpleTestCase):
+    def test_dates_and_parse(self):
+        from corpdb.utils.benchmark import fake_csv
+        text = fake_csv('000001', 'w', start=date(2013, 5, 1),
+                        end=date(2013, 5, 31), history=250)
+        self.assertEqual(text, fake_csv('000001', 'w', start=date(2013, 5, 1),
+                                        end=date(2013, 5, 31), history=250))
+        # Mondays of May 2013, without the latest and the oldest
+        self.assertEqual([b[0] for b in parse_price(text)],
+                         [date(2013, 5, 20), date(2013, 5, 13)])
+
+
+class MetricsTest(SimpleTestCase):
+    def test_counters_and_histograms(self):
+        from corpdb.utils.metrics import Metrics
+        m = Metrics()
+        m.inc('bars_inserted', 3)
+        m.inc('bars_inserted', 2)
+        m.set('queue_depth', 5)
+        m.set('queue_depth', 1)
+        for v in (0.002, 0.02, 0.2):
+            m.observe('write_seconds', v)
+        data = m.as_dict()
+        self.assertEqual(data['counters'], {'bars_inserted': 5})
+        self.assertEqual(data['gauges'], {'queue_depth': 1, 'queue_depth_max': 5})
+        self.assertEqual(data['histograms']['write_seconds']['count'], 3)
+        self.assertIn('corpdb_write_seconds_bucket{le="+Inf"} 3', m.prometheus())
+
+
+class ResponseCacheTest(SimpleTestCase):
+    def setUp(self):
+        import tempfile
+        from corpdb.utils.respcache import ResponseCache
+        self.cache = ResponseCache(tempfile.mkdtemp(), ttl=60, max_bytes=10 ** 6)
+
+    def test_put_get_and_validators(self):
+        key = self.cache.key('host', '000001.SZ', 'd', None, None)
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, YAHOO_CSV.encode(), {'ETag': '"v1"'})
+        body, meta = self.cache.get(key)
+        self.assertEqual(body, YAHOO_CSV.encode())
+        self.assertTrue(meta['fresh'])
+        self.assertEqual(self.cache.validators(meta), {'If-None-Match': '"v1"'})
+
+    def test_evict(self):
+        for i in range(3):
+            self.cache.put(self.cache.key(i), YAHOO_CSV.encode())
+        self.cache.max_bytes = 1
+        self.cache.evict()
+        self.assertIsNone(self.cache.get(self.cache.key(0)))
+
+
+class HttpClientHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.client_address[1]))
+        body = b''
+        if self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location', '/csv')
+        elif self.path == '/missing':
+            body = b'Not Found'
+            self.send_response(404)
+        elif self.path == '/same':
+            self.send_response(304)
+        else:
+            body = YAHOO_CSV.encode()
+            self.send_response(200)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            # a keep-alive response whose connection is dropped right after
+            self.close_connection = self.path == '/drop'
+        if self.path != '/same':
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpClientTest(SimpleTestCase):
+    def setUp(self):
+        from corpdb.utils.httpclient import HttpClient
+        self.server = HTTPServer(('127.0.0.1', 0), HttpClientHandler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = HttpClient(timeout=5)
+        self.url = 'http://%s:%d' % self.server.server_address
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, path, headers=None):
+        response = self.client.get(self.url + path, headers=headers)
+        try:
+            return response.status, response.read()
+        finally:
+            response.close()
+
+    def idle(self):
+        return sum(len(conns) for conns in self.client._idle.values())
+
+    def test_reuse_and_gzip(self):
+        self.assertEqual(self.fetch('/csv'), (200, YAHOO_CSV.encode()))
+        self.assertEqual(self.idle(), 1)
+        self.assertEqual(self.fetch('/csv'), (200, YAHOO_CSV.encode()))
+        self.assertEqual(self.idle(), 1)
+        ports = [port for path, port in self.server.requests]
+        self.assertEqual(ports[0], ports[1])
+
+    def test_stale_connection_retried(self):
+        self.assertEqual(self.fetch('/drop')[0], 200)
+        self.assertEqual(self.idle(), 1)
+        self.assertEqual(self.fetch('/csv'), (200, YAHOO_CSV.encode()))
+        ports = [port for path, port in self.server.requests]
+        self.assertNotEqual(ports[0], ports[-1])
+
+    def test_redirect(self):
+        self.assertEqual(self.fetch('/moved'), (200, YAHOO_CSV.encode()))
+        self.assertEqual([path for path, port in self.server.requests],
+                         ['/moved', '/csv'])
+
+    def test_errors(self):
+        from urllib.error import HTTPError
+        with self.assertRaises(HTTPError) as cm:
+            self.fetch('/missing')
+        self.assertEqual(cm.exception.code, 404)
+        # a 304 is only an answer to a conditional request
+        with self.assertRaises(HTTPError) as cm:
+            self.fetch('/same')
+        self.assertEqual(cm.exception.code, 304)
+        self.assertEqual(self.fetch('/same', {'If-None-Match': '"v1"'}), (304, b''))
+
+
+class FileSourceTest(SimpleTestCase):
+    def setUp(self):
+        import os
+        import tarfile
+        import tempfile
+        self.root = tempfile.mkdtemp()
+        mirror = os.path.join(self.root, 'mirror')
+        os.makedirs(os.path.join(mirror, 'd'))
+        with open(os.path.join(mirror, 'd', '000001.SZ.csv'), 'w',
+                  encoding='utf-8') as f:
+            f.write(YAHOO_CSV)
+        self.tarball = os.path.join(self.root, 'mirror.tar.gz')
+        with tarfile.open(self.tarball, 'w:gz') as tar:
+            # with a top level directory, as tar czf mirror.tar.gz mirror
+            tar.add(mirror, arcname='mirror')
+        self.mirror = mirror
+
+    def check(self, source):
+        from corpdb.utils.pricesource import SourceError
+        lines = list(source.open('000001.SZ', startd=date(2013, 5, 29),
+                                 endd=date(2013, 5, 30)))
+        self.assertEqual([l[:10] for l in lines],
+                         ['Date,Open,', '2013-05-30', '2013-05-29'])
+        self.assertEqual([b[0] for b in source.bars('000001.SZ')],
+                         [date(2013, 5, 30), date(2013, 5, 29)])
+        self.assertRaises(SourceError, source.open, '000002.SZ')
+        self.assertRaises(SourceError, source.open, '000001.SZ', period='w')
+
+    def test_directory(self):
+        from corpdb.utils.pricesource import get_source, FileSource
+        source = get_source('file:' + self.mirror)
+        self.assertIsInstance(source, FileSource)
+        self.check(source)
+
+    def test_tarball(self):
+        from corpdb.utils.pricesource import get_source
+        source = get_source(self.tarball)
+        try:
+            self.check(source)
+        finally:
+            source.close()
+
+
+class CodecTest(SimpleTestCase):
+    def test_scaled_round_trip(self):
+        from corpdb.utils.codec import SCALED
+        bar = (date(2013, 5, 30), 10.2, 10.6, 10.1, 10.5, 1100, 9.87)
+        row = SCALED.encode(bar)
+        self.assertEqual(row[1:6], (102000, 106000, 101000, 105000, 1100))
+        self.assertEqual(SCALED.decode(row), bar)
+        self.assertEqual(SCALED.column('adj_close', [row[4]], [row[6]]).tolist(),
+                         [9.87])
+
+    def test_reverse_split(self):
+        from corpdb.utils.codec import SCALED
+        # adj_close 25 and 30 times close, after reverse splits
+        for bar in [(date(2013, 5, 30), 0.42, 0.45, 0.41, 0.44, 5000, 11.0),
+                    (date(2013, 5, 31), 0.4, 0.4, 0.4, 0.4, 5000, 12.0)]:
+            row = SCALED.encode(bar)
+            self.assertGreater(row[6], 2 ** 31)
+            self.assertEqual(SCALED.decode(row), bar)
+
+    def test_out_of_range(self):
+        from corpdb.utils.codec import SCALED, EncodeError
+        self.assertRaises(EncodeError, SCALED.encode,
+                          (date(2013, 5, 30), 1e6, 1e6, 1e6, 1e6, 1, 1e6))
+
+
+class RetryTest(SimpleTestCase):
+    def setUp(self):
+        from unittest import mock
+        self.now = 1000.0
+        patcher = mock.patch('corpdb.utils.retry.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backoff_jitter_and_cap(self):
+        from corpdb.utils.retry import Backoff
+        backoff = Backoff(base=3, cap=20)
+        for attempt, full in [(0, 3), (1, 6), (2, 12), (3, 20), (10, 20)]:
+            for i in range(50):
+                self.assertTrue(full / 2.0 <= backoff.delay(attempt) <= full)
+
+    def test_queue_order(self):
+        from corpdb.utils.retry import RetryQueue
+        queue = RetryQueue()
+        self.assertIsNone(queue.wait_time())
+        self.assertFalse(queue.ready())
+        queue.push('b', delay=5, attempts=1)
+        queue.push('c', delay=10, attempts=2)
+        queue.push('a', delay=5)
+        self.assertFalse(queue.ready())
+        self.assertEqual(queue.wait_time(), 5)
+        self.now += 5
+        self.assertTrue(queue.ready())
+        self.assertEqual(queue.wait_time(), 0)
+        # equal times keep the push order
+        self.assertEqual([queue.pop(), queue.pop()], [('b', 1), ('a', 0)])
+        self.assertFalse(queue.ready())
+        self.assertEqual(queue.pop(), ('c', 2))
+        self.assertEqual(len(queue), 0)
+
+    def test_breaker(self):
+        from corpdb.utils.retry import CircuitBreaker
+        breaker = CircuitBreaker(threshold=3, cooldown=60)
+        self.assertFalse(breaker.failure())
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.closed())
+        self.assertTrue(breaker.failure())
+        self.assertFalse(breaker.closed())
+        self.assertEqual(breaker.wait_time(), 60)
+        self.now += 60
+        self.assertTrue(breaker.closed())
+        # half open: one more failure opens it again
+        self.assertTrue(breaker.failure())
+        self.assertFalse(breaker.closed())
+        self.now += 60
+        breaker.success()
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.closed())
+
+
+class ReadSectorsTest(SimpleTestCase):
+    def setUp(self):
+        import tempfile
+        self.cache = tempfile.mkdtemp()
+
+    def test_miss_then_hit(self):
+        import os
+        import sys
+        from unittest import mock
+        from corpdb.utils.initdb import read_sectors
+        rows = read_sectors(cache_path=self.cache)
+        self.assertEqual(rows[0], ('A', '农、林、牧、渔业', '1', '农业', '000998'))
+        self.assertEqual(len(os.listdir(self.cache)), 1)
+        # a hit needs no pandas
+        with mock.patch.dict(sys.modules, {'pandas': None}):
+            self.assertEqual(read_sectors(cache_path=self.cache), rows)
+
+    def test_keyed_by_content(self):
+        import hashlib
+        import os
+        from corpdb.utils.initdb import read_sectors
+        book = os.path.join(self.cache, 'book.xlsx')
+        with open(book, 'wb') as f:
+            f.write(b'not a workbook')
+        digest = hashlib.sha1(b'not a workbook').hexdigest()
+        with open(os.path.join(self.cache, 'cn_sectors-%s.csv' % digest), 'w',
+                  encoding='utf-8') as f:
+            f.write('C,制造业,13,农副食品加工业,000001\n')
+        self.assertEqual(read_sectors(book, cache_path=self.cache),
+                         [('C', '制造业', '13', '农副食品加工业', '000001')])
+
+    def test_read_only_cache(self):
+        import os
+        from corpdb.utils.initdb import read_sectors
+        # not a directory, like a cache path on a read-only install
+        cache = os.path.join(self.cache, 'file')
+        open(cache, 'w').close()
+        rows = read_sectors(cache_path=cache)
+        self.assertEqual(rows[0], ('A', '农、林、牧、渔业', '1', '农业', '000998'))
+
+
+class ResampleTest(SimpleTestCase):
+    def setUp(self):
+        import pandas as pd
+        rows = [(1, date(2013, 5, d), 10.0 + d, 20.0 + d, 5.0 + d, 11.0 + d,
+                 100 * d, 11.0 + d) for d in (27, 28, 29, 30, 31)]
+        rows.append((1, date(2013, 6, 3), 1.0, 2.0, 0.5, 1.5, 1000, 1.4))
+        self.daily = pd.DataFrame.from_records(rows, columns=COLUMNS)
+
+    def test_weekly(self):
+        bars = aggregate(self.daily, 'w')
+        self.assertEqual(len(bars), 2)
+        week = bars.iloc[0]
+        self.assertEqual(week['date'], date(2013, 5, 27))
+        self.assertEqual((week['open'], week['high'], week['low'], week['close']),
+                         (37.0, 51.0, 32.0, 42.0))
+        self.assertEqual(week['volume'], 2900)
+        self.assertEqual(week['adj_close'], 42.0)
+
+    def test_monthly(self):
+        bars = aggregate(self.daily, 'm')
+        self.assertEqual(list(bars['date']), [date(2013, 5, 27), date(2013, 6, 3)])
+
+
+def make_product(symbol='000001'):
+    from corpdb.models import Company, Product
+    company = Company.objects.create(symbol=symbol, name=symbol)
+    return Product.objects.create(symbol=symbol, company=company)
+
+
+def make_bars(days, close=10.0):
+    return [(date(2013, 5, d), close, close + 1, close - 1, close, 100 * d, close)
+            for d in days]
+
+
+class SaveBarsTest(TestCase):
+    def setUp(self):
+        self.product = make_product()
+
+    def test_save_bars_batches(self):
+        from corpdb.models import OhlcD
+        from corpdb.utils.saveprice import save_bars
+        with self.assertNumQueries(3):
+            count = save_bars(OhlcD, self.product, iter(make_bars(range(20, 25))),
+                              batch_size=2)
+        self.assertEqual(count, 5)
+        self.assertEqual(OhlcD.objects.filter(product=self.product).count(), 5)
+
+    def test_upsert_overwrites_overlap(self):
+        from corpdb.models import OhlcD
+        from corpdb.utils.saveprice import upsert_bars
+        upsert_bars(OhlcD, self.product, make_bars(range(20, 24)), batch_size=3)
+        upsert_bars(OhlcD, self.product, make_bars(range(22, 26), close=20.0),
+                    batch_size=3)
+        rows = dict(OhlcD.objects.filter(product=self.product)
+                    .values_list('date', 'close'))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[date(2013, 5, 21)], 10.0)
+        self.assertEqual([rows[date(2013, 5, d)] for d in range(22, 26)],
+                         [20.0] * 4)
+
+
+class ColumnarTest(TestCase):
+    def test_export_and_load(self):
+        import tempfile
+        import numpy as np
+        from corpdb.models import OhlcD
+        from corpdb.utils.columnar import export_ohlc, load_ohlc
+        from corpdb.utils.saveprice import save_bars
+        root = tempfile.mkdtemp()
+        for symbol, days in [('000001', range(20, 25)), ('000002', [22, 23])]:
+            save_bars(OhlcD, make_product(symbol), make_bars(days))
+        self.assertEqual(export_ohlc(OhlcD, 'd', root=root), 2)
+
+        arrays = load_ohlc(['000001', '000002', '000003'], 'd', root=root,
+                           start=date(2013, 5, 21), end=date(2013, 5, 23))
+        self.assertEqual(sorted(arrays), ['000001', '000002'])
+        arr = arrays['000001']
+        self.assertEqual(arr['date'].tolist(),
+                         [date(2013, 5, 21), date(2013, 5, 22), date(2013, 5, 23)])
+        self.assertEqual(arr[0].tolist(), make_bars([21])[0])
+        self.assertIsInstance(arr, np.memmap)
+        self.assertFalse(arr.flags.writeable)
+        self.assertEqual(len(load_ohlc(['000002'], root=root,
+                                       end=date(2013, 5, 22))['000002']), 1)
+
+
+class PanelTest(TestCase):
+    def setUp(self):
+        self.products = [make_product(s) for s in ('000002', '000001')]
+
+    def test_pivot(self):
+        import numpy as np
+        from corpdb.models import OhlcD
+        from corpdb.utils.panel import get_panel
+        from corpdb.utils.saveprice import save_bars
+        save_bars(OhlcD, self.products[0], make_bars([20, 21, 22], close=20.0))
+        save_bars(OhlcD, self.products[1], make_bars([21, 22, 23]))
+        panel = get_panel(field='close', start=date(2013, 5, 21),
+                          end=date(2013, 5, 23), chunk=2)
+        self.assertEqual(list(panel.columns), ['000001', '000002'])
+        self.assertEqual([d.date() for d in panel.index],
+                         [date(2013, 5, 21), date(2013, 5, 22), date(2013, 5, 23)])
+        self.assertEqual(panel['000001'].tolist(), [10.0, 10.0, 10.0])
+        self.assertEqual(panel['000002'].tolist()[:2], [20.0, 20.0])
+        self.assertTrue(np.isnan(panel['000002'].iloc[2]))
+        volume = get_panel(['000001'], field='volume')
+        self.assertEqual(list(volume.columns), ['000001'])
+        self.assertEqual(volume['000001'].tolist(), [2100, 2200, 2300])
+
+    def test_compact_adj_close(self):
+        from unittest import mock
+        from corpdb.models import CompactOhlcD
+        from corpdb.utils import panel
+        from corpdb.utils.saveprice import save_bars
+        bars = [(date(2013, 5, 30), 0.42, 0.45, 0.41, 0.44, 5000, 11.0),
+                (date(2013, 5, 31), 10.2, 10.6, 10.1, 10.5, 1100, 9.87)]
+        save_bars(CompactOhlcD, self.products[1], bars)
+        with mock.patch.dict(panel.OHLC_MODELS, {'d': CompactOhlcD}):
+            adj = panel.get_panel(field='adj_close')
+        self.assertEqual(adj['000001'].tolist(), [11.0, 9.87])
+
+
+class StaleProductsTest(TestCase):
+    def test_watermark_seeded_from_bars(self):
+        from corpdb.models import OhlcD, OhlcStatus
+        from corpdb.utils.saveprice import save_bars
+        from corpdb.management.commands.updateprice import stale_products
+        product = make_product()
+        save_bars(OhlcD, product, make_bars(range(20, 25)))
+        stocks = stale_products('d', date(2013, 6, 28))
+        self.assertEqual([(p, p.last_update) for p in stocks],
+                         [(product, date(2013, 5, 24))])
+        self.assertEqual(OhlcStatus.objects.get(product=product, period='d').last_date,
+                         date(2013, 5, 24))
+        self.assertEqual(stale_products('d', date(2013, 5, 24)), [])
+
+    def test_seed_reads_only_products_without_status(self):
+        from corpdb.models import OhlcD, OhlcStatus
+        from corpdb.utils.saveprice import save_bars, seed_status
+        product = make_product()
+        save_bars(OhlcD, product, make_bars([20]))
+        self.assertEqual(seed_status(OhlcD, 'd'), 1)
+        # every product has a watermark: no ohlc query at all
+        with self.assertNumQueries(1):
+            self.assertEqual(seed_status(OhlcD, 'd'), 0)
+        OhlcStatus.objects.all().delete()
+        with self.assertNumQueries(3):
+            self.assertEqual(seed_status(OhlcD, 'd'), 1)
+
+
+class ResampleStaleTest(TestCase):
+    def test_only_new_daily_bars_are_stale(self):
+        from corpdb.models import OhlcD, OhlcW
+        from corpdb.utils.resample import resample, stale_products
+        from corpdb.utils.saveprice import save_bars, touch_status
+        product = make_product()
+        save_bars(OhlcD, product, make_bars(range(20, 25)))
+        self.assertEqual(stale_products('w'), {product.pk: None})
+        self.assertEqual(resample(OhlcW, 'w'), 1)
+        self.assertEqual(stale_products('w'), {})
+
+        save_bars(OhlcD, product, make_bars([27]))
+        touch_status(product, 'd', last_date=date(2013, 5, 27))
+        self.assertEqual(stale_products('w'), {product.pk: date(2013, 5, 20)})
+
+
+class ProductRefsTest(TestCase):
+    def setUp(self):
+        from corpdb.models import Exchange, Sector
+        self.sz = Exchange.objects.create(symbol='SZSE', name='SZSE')
+        self.a = Exchange.objects.create(symbol='A', name='A Share', parent=self.sz)
+        self.c = Sector.objects.create(code='C', name='Manufacturing')
+        self.c13 = Sector.objects.create(code='13', name='Food', parent=self.c)
+        for symbol in ('000001', '000002'):
+            p = make_product(symbol)
+            p.exchanges.add(self.sz, self.a)
+            p.sectors.add(self.c, self.c13)
+
+    def test_refs_and_subsector(self):
+        from corpdb.models import Product
+        p = Product.objects.get(symbol='000001')
+        self.assertEqual((p.ex(), p.subex()), (self.sz, self.a))
+        self.assertEqual((p.sector(), p.subsector()), (self.c, self.c13))
+
+    def test_with_refs_query_count(self):
+        from corpdb.models import Product
+        # products with companies, then one query per prefetched relation
+        with self.assertNumQueries(3):
+            refs = [(p.company.name, p.ex(), p.subex(), p.sector(), p.subsector())
+                    for p in Product.objects.with_refs()]
+        self.assertEqual(len(refs), 2)
+        self.assertEqual(refs[0][1:], (self.sz, self.a, self.c, self.c13))
+
+
+def listing_rec(symbol, name, sub_ex, province=None, city=None):
+    from corpdb.utils.listing import row_hash
+    rec = {'symbol': symbol, 'name': name, 'market_cap': 1000, 'ipo_date': '',
+           'yahoo_sfx': '.SZ', 'sub_ex': sub_ex,
+           'company': {'symbol': symbol, 'name': name, 'name_full': name,
+                       'name_en': name, 'country': None}}
+    if province:
+        rec['company'].update(country='CN', province=province, city=city)
+    rec['hash'] = row_hash(rec)
+    return rec
+
+
+class SyncListingTest(TestCase):
+    def setUp(self):
+        from corpdb.models import Exchange
+        from corpdb.utils.refcache import registry
+        registry.clear()
+        self.sz = Exchange.objects.create(symbol='SZSE', name='SZSE')
+        self.a = Exchange.objects.create(symbol='A', name='A Share', parent=self.sz)
+        self.b = Exchange.objects.create(symbol='B', name='B Share', parent=self.sz)
+
+    def sync(self, *recs):
+        from corpdb.utils.listing import sync_listing
+        return sync_listing(list(recs), self.sz)
+
+    def test_diff(self):
+        from corpdb.models import Product
+        self.assertEqual(self.sync(listing_rec('000001', 'PAB', 'A'),
+                                   listing_rec('000002', 'Vanke', 'A'),
+                                   listing_rec('200002', 'Vanke B', 'B')),
+                         {'inserted': 3, 'updated': 0, 'delisted': 0})
+        # renamed, moved to B, delisted and newly listed
+        stats = self.sync(listing_rec('000001', 'Ping An Bank', 'A'),
+                          listing_rec('000002', 'Vanke', 'B'),
+                          listing_rec('000004', 'Guohua', 'A'))
+        self.assertEqual(stats, {'inserted': 1, 'updated': 2, 'delisted': 1})
+        self.assertEqual(Product.objects.get(symbol='000001').name, 'Ping An Bank')
+        self.assertEqual(set(Product.objects.get(symbol='000002').exchanges.all()),
+                         {self.sz, self.b})
+        self.assertTrue(Product.objects.get(symbol='200002').delisted)
+        self.assertEqual(set(Product.objects.get(symbol='000004').exchanges.all()),
+                         {self.sz, self.a})
+
+        # unchanged rows are left alone, relisted ones come back
+        stats = self.sync(listing_rec('000001', 'Ping An Bank', 'A'),
+                          listing_rec('000002', 'Vanke', 'B'),
+                          listing_rec('000004', 'Guohua', 'A'),
+                          listing_rec('200002', 'Vanke B', 'B'))
+        self.assertEqual(stats, {'inserted': 0, 'updated': 1, 'delisted': 0})
+        self.assertFalse(Product.objects.get(symbol='200002').delisted)
+        self.assertEqual(Product.objects.filter(exchanges=self.sz).count(), 4)
+
+    def test_company_moved(self):
+        from corpdb.models import Country, District
+        cn = Country.objects.create(iso='CN', name='中国')
+        gd = District.objects.create(name='广东省', level=1, country=cn)
+        sz = District.objects.create(name='深圳市', level=2, parent=gd, country=cn)
+        bj = District.objects.create(name='北京市', level=1, country=cn)
+        bj_city = District.objects.create(name='北京市', level=2, parent=bj, country=cn)
+        self.sync(listing_rec('000001', 'PAB', 'A', '广东', '深圳市'))
+        self.assertEqual([c.symbol for c in sz.companies()], ['000001'])
+
+        stats = self.sync(listing_rec('000001', 'PAB', 'A', '北京', '北京市'))
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(list(gd.companies()), [])
+        self.assertEqual([c.symbol for c in bj_city.companies()], ['000001'])
+        self.assertEqual(bj.companies()[0].country, cn)
+
+
+class UpdateListTest(TransactionTestCase):
+    # write_single really rolls back on errors
+    def test_encode_error_fails_one_symbol(self):
+        from unittest import mock
+        from corpdb.models import OhlcStatus, CompactOhlcD
+        from corpdb.management.commands import updateprice
+
+        class Source(object):
+            def bars(self, symbol, startd=None, endd=None, period='d'):
+                close = 3e5 if symbol.startswith('000001') else 10.0
+                return iter(make_bars([30], close))
+
+        products = [make_product('000001'), make_product('000002')]
+        for p in products:
+            p.last_update = None
+        with mock.patch.dict(updateprice.OHLCKlass, {'d': CompactOhlcD}):
+            self.assertFalse(updateprice.update_list(products, 'd', source=Source()))
+        self.assertEqual(list(CompactOhlcD.objects.values_list(
+            'product__symbol', flat=True)), ['000002'])
+        status = OhlcStatus.objects.get(product=products[0], period='d')
+        self.assertIn('out of range', status.last_error)
+
+    def test_flaky_symbol_retried(self):
+        from urllib.error import URLError
+        from corpdb.models import OHLC_MODELS
+        from corpdb.management.commands import updateprice
+
+        class Source(object):
+            calls = {}
+
+            def bars(self, symbol, startd=None, endd=None, period='d'):
+                self.calls[symbol] = self.calls.get(symbol, 0) + 1
+                if symbol.startswith('000001'):
+                    raise URLError('timed out')
+                return iter(make_bars([29, 30]))
+
+        source = Source()
+        products = [make_product('000001'), make_product('000002'),
+                    make_product('000003')]
+        for p in products:
+            p.last_update = None
+        self.assertFalse(updateprice.update_list(products, 'd', retry=3,
+                                                 loop_after=0, workers=2,
+                                                 source=source))
+        self.assertEqual(sorted(source.calls.values()), [1, 1, 3])
+        self.assertEqual(source.calls['000001'], 3)
+        self.assertEqual(OHLC_MODELS['d'].objects.count(), 4)
+
+    def test_overlap_fails_one_symbol(self):
+        from corpdb.models import OhlcStatus, OHLC_MODELS
+        from corpdb.management.commands import updateprice
+        from corpdb.utils import jobs
+        from corpdb.utils.saveprice import save_bars
+
+        class Source(object):
+            def bars(self, symbol, startd=None, endd=None, period='d'):
+                return iter(make_bars([29, 30]))
+
+        products = [make_product('000001'), make_product('000002')]
+        save_bars(OHLC_MODELS['d'], products[0], make_bars([29]))
+        for p in products:
+            p.last_update = None
+        job = jobs.start_job('d', date(2013, 5, 30), products)
+        self.assertFalse(updateprice.update_list(products, 'd', source=Source(),
+                                                 job=job))
+        self.assertEqual(OHLC_MODELS['d'].objects.filter(product=products[0]).count(), 1)
+        self.assertEqual(OHLC_MODELS['d'].objects.filter(product=products[1]).count(), 2)
+        status = OhlcStatus.objects.get(product=products[0], period='d')
+        self.assertTrue(status.last_error)
+        job = job.__class__.objects.get(pk=job.pk)
+        self.assertEqual(job.status, job.FAILED)
+        self.assertEqual([r['product'] for r in jobs.outstanding(job)],
+                         [products[0].pk])
+
+
+class FindJobTest(TestCase):
+    def test_only_latest_job_resumes(self):
+        from corpdb.utils import jobs
+        monday = jobs.start_job('d', date(2013, 5, 27), [])
+        jobs.finish_job(monday, failed=True)
+        self.assertEqual(jobs.find_job('d'), monday)
+
+        tuesday = jobs.start_job('d', date(2013, 5, 28), [])
+        self.assertEqual(jobs.find_job('d'), tuesday)
+        jobs.finish_job(tuesday)
+        self.assertIsNone(jobs.find_job('d'))
+        self.assertIsNone(jobs.find_job('d', shard='0/2'))
+
+
+class PartitionTest(SimpleTestCase):
+    def test_ensure_partitions_elsewhere(self):
+        from unittest import mock
+        from corpdb.models import OhlcD
+        from corpdb.utils import partition
+        with mock.patch.object(partition, 'connection') as connection:
+            connection.vendor = 'sqlite'
+            self.assertEqual(partition.ensure_partitions(OhlcD), [])
+            self.assertFalse(connection.cursor.called)
+
+
+class RefRegistryTest(TestCase):
+    def setUp(self):
+        from corpdb.models import Exchange, District
+        from corpdb.utils.refcache import registry
+        self.registry = registry
+        registry.clear()
+        self.sz = Exchange.objects.create(symbol='SZSE', name='SZSE')
+        self.a = Exchange.objects.create(symbol='A', name='A Share', parent=self.sz)
+        self.gd = District.objects.create(name='广东省', level=1)
+
+    def test_lookups(self):
+        self.assertEqual(self.registry.exchange('SZSE'), self.sz)
+        self.assertEqual(self.registry.exchange('A', self.sz), self.a)
+        self.assertEqual(self.registry.district_startswith('广东'), self.gd)
+        with self.assertNumQueries(0):
+            self.registry.exchange('A', self.sz.pk)
+
+    def test_invalidated_on_save(self):
+        from corpdb.models import Exchange
+        self.registry.exchange('SZSE')
+        b = Exchange.objects.create(symbol='B', name='B Share', parent=self.sz)
+        self.assertEqual(self.registry.exchange('B', self.sz), b)
+
+
+class PathTreeTest(TestCase):
+    def setUp(self):
+        from corpdb.models import District
+        self.gd = District.objects.create(name='广东省', level=1)
+        self.sz = District.objects.create(name='深圳市', level=2, parent=self.gd)
+        self.ft = District.objects.create(name='福田区', level=3, parent=self.sz)
+        self.bj = District.objects.create(name='北京市', level=1)
+
+    def test_paths(self):
+        self.assertEqual(self.ft.path, '%d/%d/%d/' % (self.gd.pk, self.sz.pk, self.ft.pk))
+        self.assertEqual(set(self.gd.descendants()), {self.sz, self.ft})
+        self.assertEqual(set(self.ft.ancestors()), {self.gd, self.sz})
+
+    def test_move_subtree(self):
+        from corpdb.models import District
+        self.sz.parent = self.bj
+        self.sz.save()
+        ft = District.objects.get(pk=self.ft.pk)
+        self.assertTrue(ft.path.startswith(self.bj.path))
+        self.assertEqual(list(self.gd.descendants()), [])
+
+    def test_rebuild(self):
+        from corpdb.models import District
+        District.objects.update(path='')
+        # one read, then one UPDATE per tree level
+        with self.assertNumQueries(4):
+            self.assertEqual(District.rebuild_paths(), 4)
+        self.assertEqual(District.objects.get(pk=self.ft.pk).path, self.ft.path)
+        self.assertEqual(District.objects.get(pk=self.bj.pk).path, '%d/' % self.bj.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(District.rebuild_paths(), 0)
@@ -0,0 +1,210 @@
+import time
+import random
+import logging
+import threading
+import tracemalloc
+import urllib.parse
+from datetime import date, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from django.db import connection, reset_queries
+
+from corpdb.models import Company, Exchange, Product, OhlcStatus, OHLC_MODELS
+from corpdb.utils.bulk import bulk_save, bulk_link
+from corpdb.utils.refcache import registry
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Date,Open,High,Low,Close,Volume,Adj Close\n'
+# exchange of the seeded products
+BENCH_EX = 'BENCH'
+
+
+def bar_dates(period, end, count, start=None):
+    """
+    Dates of the last `count` bars of `period` up to `end`, newest first,
+    not before `start`: weekdays, Mondays or first days of months.
+    """
+    if period == 'd':
+        d, step = end, timedelta(1)
+    elif period == 'w':
+        d, step = end - timedelta(end.weekday()), timedelta(7)
+    else:
+        d, step = end.replace(day=1), None
+    dates = []
+    while len(dates) < count and (start is None or d >= start):
+        if period != 'd' or d.weekday() < 5:
+            dates.append(d)
+        if step is None:
+            d = (d - timedelta(1)).replace(day=1)
+        else:
+            d -= step
+    return dates
+
+
+def fake_csv(symbol, period='d', start=None, end=None, history=250):
+    """
+    A yahoo table.csv of `history` bars at most, a random walk seeded by
+    the symbol, so every request of a symbol gets the same prices.
+    """
+    rnd = random.Random(symbol)
+    price = rnd.uniform(5, 50)
+    lines = [HEADER]
+    for d in bar_dates(period, end or date.today(), history, start):
+        o = price
+        c = max(0.01, o * (1 + rnd.gauss(0, 0.02)))
+        h = max(o, c) * (1 + rnd.random() * 0.01)
+        l = min(o, c) * (1 - rnd.random() * 0.01)
+        lines.append('%s,%.2f,%.2f,%.2f,%.2f,%d,%.2f\n' % (
+            d.isoformat(), o, h, l, c, rnd.randint(1000, 10 ** 6), c))
+        price = c
+    return ''.join(lines)
+
+
+def _query_date(values, m, d, y):
+    try:
+        return date(int(values[y][0]), int(values[m][0]) + 1, int(values[d][0]))
+    except (KeyError, ValueError):
+        return None
+
+
+class FakeYahooHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            body = b'Service Unavailable'
+            self.send_response(503)
+        else:
+            values = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            body = fake_csv(values.get('s', [''])[0],
+                            period=values.get('g', ['d'])[0],
+                            start=_query_date(values, 'a', 'b', 'c'),
+                            end=_query_date(values, 'd', 'e', 'f'),
+                            history=server.history).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class FakeYahooServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for ichart.finance.yahoo.com serving fake_csv, with
+    `latency` seconds of delay per request and a share `error_rate` of
+    503 responses. Runs on a daemon thread between start() and stop();
+    `host` is the value for YahooSource(host=...).
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, error_rate=0, history=250, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeYahooHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.history = history
+        self._thread = None
+
+    @property
+    def host(self):
+        return '%s:%d' % self.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def seed_products(count):
+    """
+    Insert `count` products with their companies under a BENCH exchange,
+    and return them.
+    """
+    ex = Exchange.objects.create(symbol=BENCH_EX, name='Benchmark')
+    sub_ex = Exchange.objects.create(symbol='A', name='A Share', parent=ex)
+    companies = bulk_save(Company, [Company(symbol='B%06d' % i, name='B%06d' % i)
+                                    for i in range(count)])
+    products = bulk_save(Product, [Product(symbol=c.symbol, company=c)
+                                   for c in companies])
+    bulk_link(Product.exchanges, [(p.pk, e.pk) for p in products
+                                  for e in (ex, sub_ex)])
+    return products
+
+
+def reset_prices(products, period='d'):
+    """
+    Drop the bars and watermarks of `products`, so the next update
+    downloads their whole history again.
+    """
+    OHLC_MODELS[period].objects.filter(product__in=products).delete()
+    OhlcStatus.objects.filter(product__in=products, period=period).delete()
+
+
+def clear_reference():
+    """
+    Delete the products and reference data, as before init_db.
+    """
+    for model in (Product, Company) + registry.models:
+        model.objects.all().delete()
+    registry.clear()
+
+
+def measure(func, *args, **kwargs):
+    """
+    Call func and return (result, stats): wall seconds and database
+    queries of this thread. Memory is not traced here, tracemalloc slows
+    down allocation heavy code several times; see peak_memory.
+    """
+    debug = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    reset_queries()
+    started = time.time()
+    try:
+        result = func(*args, **kwargs)
+        seconds = time.time() - started
+        queries = len(connection.queries)
+    finally:
+        connection.use_debug_cursor = debug
+        reset_queries()
+    return result, {'seconds': seconds, 'queries': queries, 'peak': None}
+
+
+def peak_memory(func, *args, **kwargs):
+    """
+    Call func with tracemalloc on and return (result, peak traced bytes).
+    Meant for a pass of its own, after the one timed by measure().
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def report(name, stats, symbols=0, bars=0):
+    """
+    stats of measure() with the rates of `symbols` and `bars` handled.
+    """
+    seconds = stats['seconds'] or 1e-9
+    stats = dict(stats, name=name, symbols=symbols, bars=bars,
+                 symbols_per_sec=symbols / seconds, bars_per_sec=bars / seconds)
+    logger.info('%(name)s: %(symbols)d symbols, %(bars)d bars in '
+                '%(seconds).2f s, %(queries)d queries' % stats)
+    if stats.get('peak') is not None:
+        logger.info('%(name)s: %(peak)d bytes peak' % stats)
+    return stats
@@ -0,0 +1,62 @@
+import uuid
+
+from django.db import connection
+from django.db.models import Max
+
+from corpdb.utils.refcache import registry
+from corpdb.utils.saveprice import BATCH_SIZE
+
+# rows fetched from the cursor at a time
+CHUNK = 10000
+
+
+def bulk_save(model, objs):
+    """
+    Insert objs with bulk_create and return the inserted rows, with
+    their pks, in pk order. bulk_create does not set pks itself.
+    Only meant for batch loads, while nothing else writes to the table.
+    """
+    last = model.objects.aggregate(last=Max('pk'))['last'] or 0
+    model.objects.bulk_create(objs, batch_size=BATCH_SIZE)
+    # bulk_create sends no signals
+    registry.invalidate(model)
+    return list(model.objects.filter(pk__gt=last).order_by('pk'))
+
+
+def bulk_link(field, pairs):
+    """
+    Insert (owner pk, target pk) pairs into the through table of the
+    many to many `field`, e.g. Product.exchanges.
+    """
+    through = field.through
+    owner = field.field.m2m_field_name() + '_id'
+    target = field.field.m2m_reverse_field_name() + '_id'
+    through.objects.bulk_create(
+        [through(**{owner: a, target: b}) for a, b in set(pairs)],
+        batch_size=BATCH_SIZE)
+
+
+def stream_rows(sql, params, chunk=CHUNK):
+    """
+    Yield lists of result rows, `chunk` at a time. On PostgreSQL a named
+    (server side) cursor keeps the result set on the server, elsewhere
+    the driver cursor is read with fetchmany. For reads too large for
+    QuerySet.iterator(), which makes psycopg2 fetch the whole result.
+    """
+    if connection.vendor == 'postgresql':
+        connection.cursor()  # make sure the connection is open
+        # unique, several may be open on one connection
+        cursor = connection.connection.cursor(
+            name='corpdb_%s' % uuid.uuid4().hex, withhold=True)
+        cursor.itersize = chunk
+    else:
+        cursor = connection.cursor()
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
@@ -0,0 +1,103 @@
+# prices are stored in 1/SCALE units
+SCALE = 10000
+# adj_close / close is stored in 1/FACTOR_SCALE units
+FACTOR_SCALE = 10 ** 8
+# largest value of an IntegerField, for prices
+INT_MAX = 2 ** 31 - 1
+# largest value of a BigIntegerField, for adj_factor
+BIGINT_MAX = 2 ** 63 - 1
+# models import this module, so numpy is only imported by column()
+
+
+class EncodeError(ValueError):
+    """
+    A bar that does not fit the fields of a codec.
+    """
+
+
+class FloatCodec(object):
+    """
+    Converts bars as yielded by parse_price,
+    (date, open, high, low, close, volume, adj_close), to and from the
+    model fields of an ohlc table, named in the order of `fields`.
+
+    This one is for one FloatField per price: bars are stored as they are.
+    """
+    fields = ('date', 'open', 'high', 'low', 'close', 'volume', 'adj_close')
+
+    def encode(self, bar):
+        return tuple(bar)
+
+    def decode(self, row):
+        return tuple(row)
+
+    def columns(self, field):
+        """
+        Model fields needed to read the bar field `field`.
+        """
+        return (field,)
+
+    def column(self, field, *values):
+        """
+        Numpy array of bar field `field` from arrays of columns(field).
+        """
+        import numpy as np
+
+        return np.asarray(values[0], dtype='i8' if field == 'volume' else 'f8')
+
+
+class ScaledCodec(FloatCodec):
+    """
+    Prices as IntegerFields of 1/SCALE units, and instead of adj_close
+    the factor adj_close / close in 1/FACTOR_SCALE units, a
+    BigIntegerField, since reverse splits push it far above 1. Prices
+    above INT_MAX / SCALE cannot be stored and raise EncodeError.
+    """
+    fields = ('date', 'open', 'high', 'low', 'close', 'volume', 'adj_factor')
+
+    def _price(self, value):
+        value = int(round(value * SCALE))
+        if not 0 <= value <= INT_MAX:
+            raise EncodeError('Price %s out of range of %s'
+                             % (value / SCALE, self.__class__.__name__))
+        return value
+
+    def encode(self, bar):
+        d, o, h, l, c, v, a = bar
+        factor = int(round(a / c * FACTOR_SCALE)) if c else FACTOR_SCALE
+        if not 0 <= factor <= BIGINT_MAX:
+            raise EncodeError('Adjustment factor %s out of range' % (a / c))
+        return (d, self._price(o), self._price(h), self._price(l),
+                self._price(c), v, factor)
+
+    def decode(self, row):
+        d, o, h, l, c, v, f = row
+        return (d, o / SCALE, h / SCALE, l / SCALE, c / SCALE, v,
+                round(c * f / (SCALE * float(FACTOR_SCALE)), 4))
+
+    def columns(self, field):
+        if field == 'adj_close':
+            return ('close', 'adj_factor')
+        return (field,)
+
+    def column(self, field, *values):
+        import numpy as np
+
+        if field == 'volume':
+            return np.asarray(values[0], dtype='i8')
+        if field == 'adj_close':
+            close, factor = (np.asarray(v, dtype='f8') for v in values)
+            return np.round(close * factor / (SCALE * float(FACTOR_SCALE)), 4)
+        return np.asarray(values[0], dtype='f8') / SCALE
+
+
+FLOAT = FloatCodec()
+SCALED = ScaledCodec()
+
+
+def get_codec(klass):
+    """
+    The codec of the ohlc model `klass`, FLOAT unless it sets `codec`.
+    Loaders and readers go through it, so they work with either storage.
+    """
+    return getattr(klass, 'codec', FLOAT)
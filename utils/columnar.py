@@ -0,0 +1,125 @@
+import os
+import logging
+from os.path import join as pjoin
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# one record per bar, one .npy file per product and period
+DTYPE = np.dtype([
+    ('date', 'M8[D]'),
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('volume', 'i8'),
+    ('adj_close', 'f8'),
+])
+FIELDS = DTYPE.names
+
+
+def get_root(root=None):
+    """
+    `root`, or the CORPDB_COLUMNAR_ROOT setting.
+    """
+    if root is None:
+        from django.conf import settings
+        root = settings.CORPDB_COLUMNAR_ROOT
+    return root
+
+
+def array_path(root, period, symbol):
+    return pjoin(root, period, symbol + '.npy')
+
+
+def _write(root, period, symbol, rows):
+    arr = np.array(rows, dtype=DTYPE)
+    path = array_path(root, period, symbol)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+    # readers never see a half written file
+    os.replace(tmp, path)
+    return len(arr)
+
+
+def export_ohlc(klass, period, root=None, products=None):
+    """
+    Write the `period` history in the table of `klass` to
+    <root>/<period>/<symbol>.npy, a date sorted array of DTYPE records
+    per product. `products` limits the export to a queryset or list of
+    products. The table is read in one ordered scan, streamed in chunks
+    from a server side cursor.
+
+    Returns the number of products written.
+    """
+    root = get_root(root)
+    os.makedirs(pjoin(root, period), exist_ok=True)
+    from corpdb.utils.bulk import stream_rows
+    from corpdb.utils.codec import get_codec
+
+    decode = get_codec(klass).decode
+    rows = klass.objects.order_by('product', 'date')
+    if products is not None:
+        rows = rows.filter(product__in=products)
+    sql, params = rows.values_list('product__symbol', *get_codec(klass).fields) \
+        .query.sql_with_params()
+
+    count = 0
+    symbol, bars = None, []
+    for chunk in stream_rows(sql, params):
+        for r in chunk:
+            if r[0] != symbol:
+                if bars:
+                    _write(root, period, symbol, bars)
+                    count += 1
+                symbol, bars = r[0], []
+            bars.append(decode(r[1:]))
+    if bars:
+        _write(root, period, symbol, bars)
+        count += 1
+
+    logger.info('Exported %s data of %d products to %s.' % (period, count, root))
+    return count
+
+
+def load_ohlc(symbols, period='d', start=None, end=None, root=None):
+    """
+    Return {symbol: array} of the exported bars between `start` and `end`
+    (dates, both inclusive). Arrays are read-only memory-mapped slices of
+    the files, so nothing is copied until values are used. Symbols not
+    exported are left out.
+    """
+    root = get_root(root)
+    result = {}
+    for symbol in symbols:
+        path = array_path(root, period, symbol)
+        if not os.path.exists(path):
+            logger.warn('%s %s data not exported.' % (symbol, period))
+            continue
+        arr = np.load(path, mmap_mode='r')
+        dates = arr['date']
+        lo = 0 if start is None else \
+            np.searchsorted(dates, np.datetime64(start, 'D'), side='left')
+        hi = len(arr) if end is None else \
+            np.searchsorted(dates, np.datetime64(end, 'D'), side='right')
+        result[symbol] = arr[lo:hi]
+    return result
+
+
+def load_frame(symbols, period='d', start=None, end=None, root=None):
+    """
+    Like load_ohlc, but as one pandas DataFrame indexed by (symbol, date).
+    Building the frame copies the data.
+    """
+    import pandas as pd
+
+    frames = []
+    for symbol, arr in load_ohlc(symbols, period, start, end, root).items():
+        df = pd.DataFrame(np.asarray(arr))
+        df.insert(0, 'symbol', symbol)
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=('symbol',) + FIELDS).set_index(['symbol', 'date'])
+    return pd.concat(frames, ignore_index=True).set_index(['symbol', 'date'])
@@ -0,0 +1,180 @@
+import io
+import gzip
+import socket
+import logging
+import threading
+import http.client
+import urllib.parse
+from urllib.error import URLError, HTTPError
+
+logger = logging.getLogger(__name__)
+
+REDIRECTS = (301, 302, 303, 307, 308)
+CONDITIONAL = ('If-None-Match', 'If-Modified-Since')
+
+# errors of an idle keep-alive connection the server already dropped
+STALE_ERRORS = (http.client.BadStatusLine, ConnectionResetError,
+                BrokenPipeError, ConnectionAbortedError)
+
+
+class PooledResponse(io.BufferedIOBase):
+    """
+    Binary file object over a response body. Closing it hands the
+    connection back to the pool when the body was read to the end and
+    the server keeps the connection alive, otherwise it is dropped.
+    """
+
+    def __init__(self, client, key, conn, response):
+        super().__init__()
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+        # body bytes handed out, after decompression
+        self.bytes_read = 0
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            self.body = gzip.GzipFile(fileobj=response, mode='rb')
+        else:
+            self.body = response
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.body.read()
+        else:
+            data = self.body.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def read1(self, size=-1):
+        if size is None or size < 0:
+            data = self.body.read()
+        else:
+            data = self.body.read1(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        # read1() leaves the response open after the last byte
+        done = self.response.isclosed() or self.response.length == 0
+        reusable = done and not self.response.will_close
+        if self.body is not self.response:
+            self.body.close()
+        self.response.close()
+        self.client.release(self.key, self.conn, reusable)
+        super().close()
+
+
+class HttpClient(object):
+    """
+    Minimal GET client keeping up to `max_per_host` idle keep-alive
+    connections per host. Safe to share between threads, each request
+    uses its connection exclusively until the response is closed.
+
+    Redirects are followed up to `max_redirects` times. Failures surface
+    as urllib.error.URLError (HTTPError for any other status than 2xx, or
+    304 to a conditional request) or socket.timeout, like
+    urllib.request.urlopen.
+    """
+
+    def __init__(self, timeout=6, max_per_host=8, gzip=True, max_redirects=5):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.max_redirects = max_redirects
+        self.gzip = gzip
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _connect(self, key, timeout):
+        scheme, netloc = key
+        klass = http.client.HTTPSConnection if scheme == 'https' \
+            else http.client.HTTPConnection
+        return klass(netloc, timeout=timeout)
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def release(self, key, conn, reusable=True):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_per_host:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def get(self, url, headers=None, timeout=None, _redirects=0):
+        """
+        Send a GET request and return a PooledResponse. The caller must
+        close it.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        req_headers = {'Connection': 'keep-alive'}
+        if self.gzip:
+            req_headers['Accept-Encoding'] = 'gzip'
+        req_headers.update(headers or {})
+
+        conn = self._acquire(key)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = self._connect(key, timeout)
+            else:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            try:
+                conn.request('GET', path, headers=req_headers)
+                response = conn.getresponse()
+                break
+            except STALE_ERRORS as e:
+                conn.close()
+                if not reused:
+                    raise URLError(e)
+                # retry once on a fresh connection
+                conn, reused = None, False
+            except socket.timeout:
+                conn.close()
+                raise
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                raise URLError(e)
+
+        response = PooledResponse(self, key, conn, response)
+        status = response.status
+        if 200 <= status < 300:
+            return response
+        if status == 304 and any(h in req_headers for h in CONDITIONAL):
+            return response
+
+        body = response.read()
+        response.close()
+        location = response.headers.get('Location')
+        if status in REDIRECTS and location and _redirects < self.max_redirects:
+            return self.get(urllib.parse.urljoin(url, location), headers=headers,
+                            timeout=timeout, _redirects=_redirects + 1)
+        raise HTTPError(url, status, response.response.reason,
+                        response.headers, io.BytesIO(body))
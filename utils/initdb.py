@@ -1,18 +1,23 @@
+import os
 import csv
+import hashlib
 import logging
-from os.path import abspath, dirname
+from os.path import abspath, dirname, exists
 from os.path import join as pjoin
 
-import pandas as pd
 import string
-from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 
 from corpdb.models import *
+from corpdb.utils.bulk import bulk_save, bulk_link, BATCH_SIZE
+from corpdb.utils.listing import insert_listing, sz_listing, nasdaq_listing
+from corpdb.utils.refcache import registry
 
 logger = logging.getLogger(__name__)
 DATA_PATH = pjoin(abspath(dirname(dirname(__file__))),
                   'data')
+# parsed copies of data files, see read_sectors
+CACHE_PATH = pjoin(DATA_PATH, '_cache')
 
 
 @transaction.commit_on_success
@@ -28,13 +33,13 @@ def InitCountries():
     countries_cn = list(csv.DictReader(open(cn_county_file, 'r', encoding='utf-8')))
     countries_cn = {c['iso']: c['name'] for c in countries_cn}
 
-    for item in countries_en:
-        country = Country(
-            iso=item['iso'],
-            name=countries_cn.get(item['iso'], ''),
-            name_en=item['name'],
-        )
-        country.save()
+    Country.objects.bulk_create(
+        [Country(iso=item['iso'],
+                 name=countries_cn.get(item['iso'], ''),
+                 name_en=item['name'])
+         for item in countries_en],
+        batch_size=BATCH_SIZE)
+    registry.invalidate(Country)
 
     logger.info('Init countries: succeed.')
 
@@ -47,38 +52,36 @@ def InitCnDistricts():
 
     district_file = pjoin(DATA_PATH, 'cn_postcode_phonecode.csv')
 
-    cn = Country.objects.get(iso='CN')
+    cn = registry.country('CN')
 
     recs = list(csv.DictReader(open(district_file, 'r', encoding='utf-8')))
+
+    # One level at a time, so parents have pks when children are built.
     provinces = {}
-    cities = {}
+    for r in recs:
+        if r['省'] not in provinces:
+            provinces[r['省']] = District(name=r['省'], level=1, country=cn)
+    provinces = {p.name: p for p in bulk_save(District, list(provinces.values()))}
 
+    cities = {}
     for r in recs:
-        zipcode = ''
-        p = provinces.get(r['省'], None)
-        if not p:
-            # Insert province
-            p = District(name=r['省'], level=1, country=cn)
-            p.save()
-            provinces[r['省']] = p
-
-        if r['市']:
-            if not r['区县']:
-                zipcode = r['邮政编码']
-            c = cities.get(r['省'] + r['市'], None)
-            if not c:
-            # Insert city
-                c = District(name=r['市'], level=2, parent=p,
-                             zipcode=zipcode, country=cn)
-                c.save()
-
-                cities[r['省'] + r['市']] = c
-
-            if r['区县']:
-                zipcode = r['邮政编码']
-                z = District(name=r['区县'], level=3, parent=c,
-                             zipcode=zipcode, country=cn)
-                z.save()
+        key = (r['省'], r['市'])
+        if r['市'] and key not in cities:
+            cities[key] = District(name=r['市'], level=2,
+                                   parent=provinces[r['省']],
+                                   zipcode='' if r['区县'] else r['邮政编码'],
+                                   country=cn)
+    cities = {(c.parent_id, c.name): c
+              for c in bulk_save(District, list(cities.values()))}
+
+    District.objects.bulk_create(
+        [District(name=r['区县'], level=3,
+                  parent=cities[(provinces[r['省']].pk, r['市'])],
+                  zipcode=r['邮政编码'], country=cn)
+         for r in recs if r['市'] and r['区县']],
+        batch_size=BATCH_SIZE)
+    District.rebuild_paths()
+    registry.invalidate(District)
 
     logger.info('Init districts: succeed.')
 
@@ -124,54 +127,51 @@ def InitSZStock():
     if Product.objects.count() > 0:
         logger.warn('Products exist, skip InitSZStock.')
         return
-    sz_file = pjoin(DATA_PATH, 'szse-all.csv')
+    sz_ex = registry.exchange('SZSE')
+    insert_listing(list(sz_listing()), sz_ex)
 
-    cn = Country.objects.get(iso='CN')
-    sz_ex = Exchange.objects.get(symbol='SZSE', parent=None)
-    recs = csv.DictReader(open(sz_file, 'r', encoding='utf-8'))
+    logger.info('Initialize SZStocks: succeed.')
 
-    for r in recs:
-        c_symbol = r['公司代码'].zfill(6)
-        c_name = r['公司简称'].replace(' ', '')
-        c_name_full = r['公司全称'].strip()
-        c_name_en = r['英文名称'].strip()
-        c_prov = r['省 份'].strip()
-        c_city = r['城 市'].strip()
-
-        province = District.objects.get(name__startswith=c_prov, parent=None)
-
-        try:
-            city = District.objects.get(name=c_city, parent=province)
-        except ObjectDoesNotExist:
-            city = None
-            logger.warn('City %s not found.' % c_city)
-
-        comp = Company(symbol=c_symbol, name=c_name, name_full=c_name_full,
-                       name_en=c_name_en, country=cn)
-
-        comp.save()
-
-        comp.districts.add(province)
-
-        if city:
-            comp.districts.add(city)
-
-        for c in 'AB':
-            if r[c + '股代码']:
-                sub_ex = Exchange.objects.get(symbol=c, parent=sz_ex)
-
-                product = Product(symbol=r[c + '股代码'].zfill(6),
-                                  name=r[c + '股简称'].replace(' ', ''),
-                                  company=comp,
-                                  market_cap=int(r[c + '股流通股本'].strip()),
-                                  ipo_date=r[c + '股上市日期'].strip(),
-                                  yahoo_sfx='.SZ',
-                )
-                product.save()
-                product.exchanges.add(sz_ex)
-                product.exchanges.add(sub_ex)
 
-    logger.info('Initialize SZStocks: succeed.')
+def read_sectors(file=None, cache_path=CACHE_PATH):
+    """
+    Return (menlei, menlei_name, hangye, hangye_name, code) rows of the
+    CSRC sector workbook.
+
+    The workbook is parsed with pandas once and the rows are cached as a
+    csv named after the sha1 of the workbook, so later loads skip pandas
+    and openpyxl entirely until the workbook changes. The cache is best
+    effort: on a read-only install the rows are just not cached.
+    """
+    file = file or pjoin(DATA_PATH, 'cn_sectors.xlsx')
+    with open(file, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    cache = pjoin(cache_path, 'cn_sectors-%s.csv' % digest)
+    if exists(cache):
+        with open(cache, 'r', encoding='utf-8', newline='') as f:
+            return [tuple(r) for r in csv.reader(f)]
+
+    import pandas as pd
+
+    df = pd.read_excel(file, 'Sheet1').ffill()
+    rows = []
+    for data in df.itertuples(index=False):
+        menlei = set(data[0]).intersection(string.ascii_uppercase).pop()
+        rows.append((menlei,
+                     data[0][:-3],
+                     str(int(data[1])),
+                     data[2],
+                     str(int(data[3])).zfill(6)))
+
+    tmp = cache + '.tmp'
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        with open(tmp, 'w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(rows)
+        os.replace(tmp, cache)
+    except OSError as e:
+        logger.warn('Cannot cache sectors in %s: %s' % (cache_path, e))
+    return rows
 
 
 @transaction.commit_on_success
@@ -179,46 +179,44 @@ def InitCnSectors():
     if Sector.objects.count() > 0:
         logger.warn('Sectors exist, skip.')
         return
-    file = pjoin(DATA_PATH, 'cn_sectors.xlsx')
-    sectors = {}
-    sub_sectors = {}
-    df = pd.read_excel(file, 'Sheet1').fillna(method='ffill')
     sector_standard, created = SectorStandard.objects.get_or_create(
         abbr='CSRC',
         name='中国证监会上市公司行业分类指引'
     )
     if created:
         sector_standard.save()
+    products = dict(Product.objects.values_list('symbol', 'pk'))
 
-    for row in df.iterrows():
-        data = row[1]
-        menlei = set(data[0]).intersection(string.ascii_uppercase).pop()
-        menlei_name = data[0][:-3]
-        hangye = int(data[1])
-        hangye_name = data[2]
-        code = str(int(data[3])).zfill(6)
-
-        try:
-            product = Product.objects.get(symbol=code)
-        except ObjectDoesNotExist:
-            logger.warn('%s not found!' % code)
-            product = None
-        if product:
-            sector = sectors.get(menlei, None)
-            if sector is None:
-                sector = Sector(code=menlei, name=menlei_name, standard=sector_standard)
-                sector.save()
-                sectors[menlei] = sector
-
-            sub_sector = sub_sectors.get(hangye, None)
-            if sub_sector is None:
-                sub_sector = Sector(code=hangye, name=hangye_name,
-                                    parent=sector, standard=sector_standard)
-                sub_sector.save()
-                sub_sectors[hangye] = sub_sector
-            product.sectors.add(sector)
-            product.sectors.add(sub_sector)
-            logger.info('%s added: %s-%s' % (code, menlei, hangye))
+    rows = []
+    for row in read_sectors():
+        if row[4] in products:
+            rows.append(row)
+        else:
+            logger.warn('%s not found!' % row[4])
+
+    sectors = {}
+    for menlei, menlei_name, hangye, hangye_name, code in rows:
+        if menlei not in sectors:
+            sectors[menlei] = Sector(code=menlei, name=menlei_name,
+                                     standard=sector_standard)
+    sectors = {s.code: s for s in bulk_save(Sector, list(sectors.values()))}
+
+    sub_sectors = {}
+    for menlei, menlei_name, hangye, hangye_name, code in rows:
+        if hangye not in sub_sectors:
+            sub_sectors[hangye] = Sector(code=hangye, name=hangye_name,
+                                         parent=sectors[menlei],
+                                         standard=sector_standard)
+    sub_sectors = {s.code: s for s in bulk_save(Sector, list(sub_sectors.values()))}
+
+    links = []
+    for menlei, menlei_name, hangye, hangye_name, code in rows:
+        links.append((products[code], sectors[menlei].pk))
+        links.append((products[code], sub_sectors[hangye].pk))
+    bulk_link(Product.sectors, links)
+    Sector.rebuild_paths()
+    registry.invalidate(Sector)
+    logger.info('Init sectors: %d products added.' % len(rows))
 
 
 @transaction.commit_on_success
@@ -227,47 +225,27 @@ def ImportNasdaqStock(file, ex, sub_ex):
         logger.warn('Products in %s exist, skip' % sub_ex)
         return
 
-    recs = csv.DictReader(open(file, 'r', encoding='utf-8'))
-
-    for r in recs:
-        c_name = r['Name'].strip()
-        cq = Company.objects.filter(name=c_name)
-        if len(cq) == 0:
-            comp = Company(name=c_name, name_full=c_name, name_en=c_name)
-            comp.save()
-        elif len(cq) == 1:
-            comp = cq[0]
-        else:
-            raise Exception
-
-        product = Product(symbol=r['Symbol'].strip(),
-                          company=comp,
-                          market_cap=int(float(r['MarketCap'].strip())),
-                          ipo_date='' if r['IPOyear'] == 'n/a'
-                          else r['IPOyear'].strip())
-        product.save()
-        product.exchanges.add(ex)
-        product.exchanges.add(sub_ex)
+    insert_listing(list(nasdaq_listing(file, sub_ex.symbol)), ex)
 
     logger.info('Initialize %s: suceed.' % sub_ex)
 
 
 def InitNasdaqStock():
-    nasdaq_ex = Exchange.objects.get(symbol='NASDAQ', parent=None)
+    nasdaq_ex = registry.exchange('NASDAQ')
 
     cm_file = pjoin(DATA_PATH, 'nasdaq-cm.csv')
     gm_file = pjoin(DATA_PATH, 'nasdaq-gm.csv')
     gs_file = pjoin(DATA_PATH, 'nasdaq-gs.csv')
 
-    ex_get = Exchange.objects.get
+    ex_get = registry.exchange
     sub_exes = {'CM': {'file': cm_file,
-                       'sub_ex': ex_get(symbol='CM', parent=nasdaq_ex),
+                       'sub_ex': ex_get('CM', nasdaq_ex),
     },
                 'GM': {'file': gm_file,
-                       'sub_ex': ex_get(symbol='GM', parent=nasdaq_ex),
+                       'sub_ex': ex_get('GM', nasdaq_ex),
                 },
                 'GS': {'file': gs_file,
-                       'sub_ex': ex_get(symbol='GS', parent=nasdaq_ex),
+                       'sub_ex': ex_get('GS', nasdaq_ex),
                 },
     }
 
@@ -0,0 +1,56 @@
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from corpdb.models import UpdateJob, UpdateJobItem
+from corpdb.utils.bulk import BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+@transaction.commit_on_success
+def start_job(period, last_trade, products, shard='', exchange=''):
+    """
+    Record a new UpdateJob of `period` with one pending item per product
+    of `products`, the stale set of this run.
+    """
+    job = UpdateJob.objects.create(period=period, last_trade=last_trade,
+                                   shard=shard or '', exchange=exchange or '',
+                                   started=timezone.now())
+    UpdateJobItem.objects.bulk_create(
+        [UpdateJobItem(job=job, product=p) for p in products],
+        batch_size=BATCH_SIZE)
+    return job
+
+
+def find_job(period, shard='', exchange=''):
+    """
+    The latest job of `period`, `shard` and `exchange`, if it is still
+    running or failed, or None. Older jobs are superseded by any later
+    run, which selected its own stale set.
+    """
+    jobs = UpdateJob.objects.filter(period=period, shard=shard or '',
+                                    exchange=exchange or '') \
+        .order_by('-started', '-pk')[:1]
+    if jobs and jobs[0].status != UpdateJob.DONE:
+        return jobs[0]
+    return None
+
+
+def outstanding(job):
+    """
+    Products of `job` not updated yet, pending or failed.
+    """
+    return job.items.exclude(status=UpdateJobItem.DONE).values('product')
+
+
+def mark_item(job, product, status, attempts, error=''):
+    UpdateJobItem.objects.filter(job=job, product=product).update(
+        status=status, attempts=attempts, last_error=error)
+
+
+def finish_job(job, failed=False):
+    job.status = UpdateJob.FAILED if failed else UpdateJob.DONE
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'finished'])
@@ -0,0 +1,216 @@
+import csv
+import json
+import hashlib
+import logging
+from os.path import join as pjoin
+
+from django.db import transaction
+
+from corpdb.models import Company, Product, District
+from corpdb.utils.bulk import bulk_save, bulk_link
+from corpdb.utils.refcache import registry
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_FIELDS = ('name', 'market_cap', 'ipo_date', 'yahoo_sfx')
+COMPANY_FIELDS = ('symbol', 'name', 'name_full', 'name_en')
+
+
+def data_file(name):
+    from corpdb.utils.initdb import DATA_PATH
+    return pjoin(DATA_PATH, name)
+
+
+def row_hash(rec):
+    return hashlib.sha1(json.dumps(rec, sort_keys=True).encode()).hexdigest()
+
+
+def sz_listing(file=None):
+    """
+    Yield one record per product of szse-all.csv: a dict with the product
+    fields, the sub exchange symbol and the company fields, and `hash`
+    over all of them.
+    """
+    file = file or data_file('szse-all.csv')
+    for r in csv.DictReader(open(file, 'r', encoding='utf-8')):
+        company = {'symbol': r['公司代码'].zfill(6),
+                   'name': r['公司简称'].replace(' ', ''),
+                   'name_full': r['公司全称'].strip(),
+                   'name_en': r['英文名称'].strip(),
+                   'country': 'CN',
+                   'province': r['省 份'].strip(),
+                   'city': r['城 市'].strip(),
+                   }
+        for c in 'AB':
+            if r[c + '股代码']:
+                rec = {'symbol': r[c + '股代码'].zfill(6),
+                       'name': r[c + '股简称'].replace(' ', ''),
+                       'market_cap': int(r[c + '股流通股本'].strip()),
+                       'ipo_date': r[c + '股上市日期'].strip(),
+                       'yahoo_sfx': '.SZ',
+                       'sub_ex': c,
+                       'company': company,
+                       }
+                rec['hash'] = row_hash(rec)
+                yield rec
+
+
+def nasdaq_listing(file, sub_ex):
+    """
+    Like sz_listing, for a nasdaq-*.csv file of sub exchange `sub_ex`.
+    """
+    for r in csv.DictReader(open(file, 'r', encoding='utf-8')):
+        c_name = r['Name'].strip()
+        rec = {'symbol': r['Symbol'].strip(),
+               'name': '',
+               'market_cap': int(float(r['MarketCap'].strip())),
+               'ipo_date': '' if r['IPOyear'] == 'n/a' else r['IPOyear'].strip(),
+               'yahoo_sfx': '',
+               'sub_ex': sub_ex,
+               'company': {'symbol': '', 'name': c_name, 'name_full': c_name,
+                           'name_en': c_name, 'country': None},
+               }
+        rec['hash'] = row_hash(rec)
+        yield rec
+
+
+def _company_key(company):
+    # shenzhen companies have codes, nasdaq ones only names
+    return company['symbol'] or company['name']
+
+
+def _company_map():
+    companies = {}
+    for pk, symbol, name in Company.objects.values_list('pk', 'symbol', 'name'):
+        companies.setdefault(symbol or name, []).append(pk)
+    return companies
+
+
+def _company_districts(company):
+    province = registry.district_startswith(company['province'])
+    pks = [province.pk]
+    try:
+        pks.append(registry.district(company['city'], province).pk)
+    except District.DoesNotExist:
+        logger.warn('City %s not found.' % company['city'])
+    return pks
+
+
+def _relink_districts(companies):
+    """
+    Link the companies of `companies`, {pk: company fields}, to the
+    districts of their current province and city, where these changed.
+    """
+    through = Company.districts.through
+    linked = {}
+    for company, district in through.objects.filter(
+            company__in=list(companies)).values_list('company', 'district'):
+        linked.setdefault(company, set()).add(district)
+    links = {}
+    for pk, c in companies.items():
+        districts = _company_districts(c)
+        if set(districts) != linked.get(pk, set()):
+            links[pk] = districts
+    if not links:
+        return
+    through.objects.filter(company__in=list(links)).delete()
+    bulk_link(Company.districts, [(pk, d) for pk, districts in links.items()
+                                  for d in districts])
+
+
+def insert_listing(records, ex):
+    """
+    Bulk insert the products of `records` under exchange `ex`, with
+    companies that do not exist yet. Returns the number of products.
+    """
+    companies = _company_map()
+    new = {}
+    for rec in records:
+        c = rec['company']
+        key = _company_key(c)
+        if key not in companies and key not in new:
+            new[key] = c
+    saved = bulk_save(Company, [
+        Company(country=registry.country(c['country']) if c['country'] else None,
+                **dict((f, c[f]) for f in COMPANY_FIELDS))
+        for c in new.values()])
+    districts = []
+    for comp in saved:
+        companies.setdefault(comp.symbol or comp.name, []).append(comp.pk)
+        c = new[comp.symbol or comp.name]
+        if c.get('province'):
+            districts.extend((comp.pk, pk) for pk in _company_districts(c))
+    bulk_link(Company.districts, districts)
+
+    products = []
+    sub_ex_of = {}
+    for rec in records:
+        cq = companies[_company_key(rec['company'])]
+        if len(cq) > 1:
+            raise Exception('Company %s is ambiguous.' % _company_key(rec['company']))
+        products.append(Product(symbol=rec['symbol'], company_id=cq[0],
+                                src_hash=rec['hash'],
+                                **dict((f, rec[f]) for f in PRODUCT_FIELDS)))
+        sub_ex_of[rec['symbol']] = registry.exchange(rec['sub_ex'], ex)
+
+    exchanges = []
+    for product in bulk_save(Product, products):
+        exchanges.append((product.pk, ex.pk))
+        exchanges.append((product.pk, sub_ex_of[product.symbol].pk))
+    bulk_link(Product.exchanges, exchanges)
+    return len(products)
+
+
+@transaction.commit_on_success
+def sync_listing(records, ex, dry_run=False):
+    """
+    Apply the difference between `records`, the full current listing of
+    exchange `ex`, and its products in the database: insert new symbols,
+    update those whose row hash changed, and flag the ones no longer
+    listed as delisted. Unchanged rows are not touched.
+
+    Returns a dict with the number of inserted, updated and delisted
+    products.
+    """
+    records = dict((rec['symbol'], rec) for rec in records)
+    existing = dict((symbol, (pk, src_hash, delisted, company_id))
+                    for pk, symbol, src_hash, delisted, company_id in
+                    Product.objects.filter(exchanges=ex).values_list(
+                        'pk', 'symbol', 'src_hash', 'delisted', 'company'))
+
+    inserts = [rec for symbol, rec in records.items() if symbol not in existing]
+    updates = [(existing[symbol], rec) for symbol, rec in records.items()
+               if symbol in existing and
+               (existing[symbol][1] != rec['hash'] or existing[symbol][2])]
+    delists = [pk for symbol, (pk, h, delisted, c) in existing.items()
+               if symbol not in records and not delisted]
+    stats = {'inserted': len(inserts), 'updated': len(updates),
+             'delisted': len(delists)}
+    if dry_run:
+        return stats
+
+    insert_listing(inserts, ex)
+
+    subs = dict((e.symbol, e) for e in registry.children(ex))
+    for (pk, h, delisted, company_id), rec in updates:
+        c = rec['company']
+        Product.objects.filter(pk=pk).update(
+            src_hash=rec['hash'], delisted=False,
+            **dict((f, rec[f]) for f in PRODUCT_FIELDS))
+        Company.objects.filter(pk=company_id).update(
+            country=registry.country(c['country']) if c['country'] else None,
+            **dict((f, c[f]) for f in COMPANY_FIELDS))
+        # the product may have moved to another sub exchange
+        through = Product.exchanges.through
+        through.objects.filter(product=pk,
+                               exchange__in=list(subs.values())).delete()
+        bulk_link(Product.exchanges, [(pk, subs[rec['sub_ex']].pk)])
+    _relink_districts(dict((company_id, rec['company'])
+                           for (pk, h, d, company_id), rec in updates
+                           if rec['company'].get('province')))
+
+    Product.objects.filter(pk__in=delists).update(delisted=True)
+
+    logger.info('Synced %s: %d inserted, %d updated, %d delisted.'
+                % (ex, stats['inserted'], stats['updated'], stats['delisted']))
+    return stats
@@ -0,0 +1,163 @@
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PREFIX = 'corpdb_'
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the `q` quantile, max for the
+        last bucket.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min,
+                'max': self.max, 'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'],
+                                    self.counts))}
+
+
+class Metrics(object):
+    """
+    Thread safe counters, gauges and histograms of one process, cheap
+    enough to update per request and per symbol. Names are plain strings
+    like 'bars_inserted'; histograms hold durations in seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+            peak = name + '_max'
+            self.gauges[peak] = max(self.gauges.get(peak, value), value)
+
+    def observe(self, name, value):
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def as_dict(self):
+        with self._lock:
+            return {'seconds': time.time() - self.started,
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'histograms': dict((k, h.as_dict())
+                                       for k, h in self.histograms.items())}
+
+    def summary(self):
+        """
+        Human readable lines: counters, gauges, then count, total and
+        p50/p95/max of each histogram.
+        """
+        data = self.as_dict()
+        lines = ['Run took %.1f s.' % data['seconds']]
+        for name, value in sorted(data['counters'].items()):
+            lines.append('%-24s %d' % (name, value))
+        for name, value in sorted(data['gauges'].items()):
+            lines.append('%-24s %s' % (name, value))
+        for name, h in sorted(data['histograms'].items()):
+            lines.append('%-24s n=%d total=%.2fs p50=%.3fs p95=%.3fs max=%.3fs'
+                         % (name, h['count'], h['sum'], h['p50'], h['p95'],
+                            h['max']))
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """
+        The metrics in the Prometheus text exposition format, e.g. for
+        the textfile collector of node_exporter.
+        """
+        data = self.as_dict()
+        lines = []
+        for name, value in sorted(data['counters'].items()):
+            name = PREFIX + name + '_total'
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %s' % (name, value))
+        for name, value in sorted(data['gauges'].items()):
+            name = PREFIX + name
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, value))
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            for name, h in histograms:
+                name = PREFIX + name
+                lines.append('# TYPE %s histogram' % name)
+                seen = 0
+                for bound, n in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    seen += n
+                    lines.append('%s_bucket{le="%s"} %d' % (name, bound, seen))
+                lines.append('%s_sum %s' % (name, h.sum))
+                lines.append('%s_count %d' % (name, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Write the metrics to `path`, in the Prometheus text format for
+        .prom files, as json otherwise.
+        """
+        if path.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+
+metrics = Metrics()
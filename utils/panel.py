@@ -0,0 +1,55 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from corpdb.models import OHLC_MODELS
+from corpdb.utils.bulk import stream_rows, CHUNK
+from corpdb.utils.codec import get_codec
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('open', 'high', 'low', 'close', 'volume', 'adj_close')
+
+
+def get_panel(symbols=None, field='close', start=None, end=None, period='d',
+              chunk=CHUNK):
+    """
+    Return a date x symbol DataFrame of `field` for `period` bars between
+    `start` and `end`, both inclusive. `symbols` defaults to all products.
+    Missing bars are NaN.
+
+    The whole panel is read by one query, streamed in chunks and pivoted
+    with numpy, without building model instances.
+    """
+    if field not in FIELDS:
+        raise ValueError('Unknown field "%s", choose one of %s'
+                         % (field, ', '.join(FIELDS)))
+    klass = OHLC_MODELS[period]
+    codec = get_codec(klass)
+    qs = klass.objects.all()
+    if symbols is not None:
+        qs = qs.filter(product__symbol__in=list(symbols))
+    if start is not None:
+        qs = qs.filter(date__gte=start)
+    if end is not None:
+        qs = qs.filter(date__lte=end)
+    sql, params = qs.values_list('product__symbol', 'date',
+                                 *codec.columns(field)).query.sql_with_params()
+
+    syms, dates, values = [], [], []
+    for rows in stream_rows(sql, params, chunk):
+        cols = list(zip(*rows))
+        syms.append(np.array(cols[0], dtype=object))
+        dates.append(np.array(cols[1], dtype='datetime64[D]'))
+        values.append(codec.column(field, *cols[2:]).astype('f8'))
+
+    if not syms:
+        return pd.DataFrame(columns=list(symbols or []), dtype='f8')
+
+    columns, col = np.unique(np.concatenate(syms), return_inverse=True)
+    index, row = np.unique(np.concatenate(dates), return_inverse=True)
+    data = np.full((len(index), len(columns)), np.nan)
+    data[row, col] = np.concatenate(values)
+    return pd.DataFrame(data, index=pd.DatetimeIndex(index, name='date'),
+                        columns=pd.Index(columns, name='symbol'))
@@ -0,0 +1,197 @@
+import logging
+from datetime import date
+
+from django.db import connection, transaction
+
+from corpdb.utils.codec import get_codec
+
+logger = logging.getLogger(__name__)
+
+# first partition year, before the oldest yahoo data
+FIRST_YEAR = 1990
+
+
+def _check_vendor():
+    if connection.vendor != 'postgresql':
+        raise ValueError('Partitioning needs PostgreSQL 12 or later, not %s.'
+                         % connection.vendor)
+
+
+def _names(klass):
+    qn = connection.ops.quote_name
+    meta = klass._meta
+    codec = get_codec(klass)
+    # what cross sections of close and adj_close read
+    include = []
+    for f in codec.columns('close') + codec.columns('adj_close'):
+        if qn(meta.get_field(f).column) not in include:
+            include.append(qn(meta.get_field(f).column))
+    return dict(table=meta.db_table,
+                qtable=qn(meta.db_table),
+                pk=qn(meta.pk.column),
+                date=qn(meta.get_field('date').column),
+                product=qn(meta.get_field('product').column),
+                include=', '.join(include),
+                product_table=qn(meta.get_field('product').rel.to._meta.db_table))
+
+
+def partition_name(table, year):
+    return '%s_y%d' % (table, year)
+
+
+def is_partitioned(klass):
+    _check_vendor()
+    cursor = connection.cursor()
+    cursor.execute('SELECT 1 FROM pg_partitioned_table p '
+                   'JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s',
+                   [klass._meta.db_table])
+    return cursor.fetchone() is not None
+
+
+def partition_years(klass):
+    """
+    Years of the existing partitions of the table of `klass`, sorted.
+    """
+    _check_vendor()
+    table = klass._meta.db_table
+    cursor = connection.cursor()
+    cursor.execute('SELECT c.relname FROM pg_inherits i '
+                   'JOIN pg_class c ON c.oid = i.inhrelid '
+                   'JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s',
+                   [table])
+    prefix = table + '_y'
+    return sorted(int(name[len(prefix):]) for name, in cursor.fetchall()
+                  if name.startswith(prefix))
+
+
+@transaction.commit_on_success
+def create_partitions(klass, first, last):
+    """
+    Create the missing yearly partitions from `first` to `last`, both
+    inclusive. Returns the years created.
+    """
+    return _create_partitions(klass, first, last)
+
+
+def _create_partitions(klass, first, last):
+    n = _names(klass)
+    qn = connection.ops.quote_name
+    existing = set(partition_years(klass))
+    cursor = connection.cursor()
+    created = []
+    for year in range(first, last + 1):
+        if year in existing:
+            continue
+        cursor.execute('CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)'
+                       % (qn(partition_name(n['table'], year)), n['qtable']),
+                       [date(year, 1, 1), date(year + 1, 1, 1)])
+        created.append(year)
+    transaction.set_dirty()
+    return created
+
+
+def ensure_partitions(klass, ahead=1):
+    """
+    Create the missing partitions of the current year and `ahead` years
+    after it when the table of `klass` is partitioned, so new bars always
+    find one. A no-op on other databases. Returns the years created.
+    """
+    if connection.vendor != 'postgresql' or not is_partitioned(klass):
+        return []
+    year = date.today().year
+    created = create_partitions(klass, year, year + ahead)
+    if created:
+        logger.info('Created %s partitions: %s' % (klass._meta.db_table, created))
+    return created
+
+
+@transaction.commit_on_success
+def partition_table(klass, ahead=1):
+    """
+    Turn the table of `klass` into one range partitioned by year of date,
+    with partitions from FIRST_YEAR, or its oldest bar if older, to
+    `ahead` years after the current one. Rows are copied over in one
+    transaction, so run it in a maintenance window.
+
+    The primary key becomes (id, date), as PostgreSQL requires the
+    partition key in unique constraints; ids stay unique through their
+    sequence. Other indexes of the old table are not recreated, see
+    create_covering_index. Returns False if the table is partitioned
+    already.
+    """
+    if is_partitioned(klass):
+        return False
+    n = _names(klass)
+    qn = connection.ops.quote_name
+    old = n['table'] + '_unpartitioned'
+    cursor = connection.cursor()
+
+    cursor.execute('SELECT MIN(%s) FROM %s' % (n['date'], n['qtable']))
+    oldest = cursor.fetchone()[0]
+    first = min(oldest.year, FIRST_YEAR) if oldest else FIRST_YEAR
+
+    cursor.execute('ALTER TABLE %s RENAME TO %s' % (n['qtable'], qn(old)))
+    cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) '
+                   'PARTITION BY RANGE (%s)' % (n['qtable'], qn(old), n['date']))
+    # keep the id sequence when the old table is dropped
+    cursor.execute('SELECT pg_get_serial_sequence(%s, %s)',
+                   [old, klass._meta.pk.column])
+    sequence = cursor.fetchone()[0]
+    if sequence:
+        cursor.execute('ALTER SEQUENCE %s OWNED BY %s.%s'
+                       % (sequence, n['qtable'], n['pk']))
+
+    _create_partitions(klass, first, date.today().year + ahead)
+    cursor.execute('INSERT INTO %s SELECT * FROM %s' % (n['qtable'], qn(old)))
+    # frees the constraint and index names for the new table
+    cursor.execute('DROP TABLE %s' % qn(old))
+
+    cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (%s, %s)'
+                   % (n['qtable'], n['pk'], n['date']))
+    cursor.execute('ALTER TABLE %s ADD UNIQUE (%s, %s)'
+                   % (n['qtable'], n['product'], n['date']))
+    cursor.execute('ALTER TABLE %s ADD FOREIGN KEY (%s) REFERENCES %s (id) '
+                   'DEFERRABLE INITIALLY DEFERRED'
+                   % (n['qtable'], n['product'], n['product_table']))
+    transaction.set_dirty()
+    logger.info('Partitioned %s by year from %d.' % (n['table'], first))
+    return True
+
+
+@transaction.commit_on_success
+def drop_partitions(klass, before):
+    """
+    Detach and drop the partitions of years before `before`, deleting
+    their bars. Much cheaper than a DELETE of the same rows. Returns the
+    years dropped.
+    """
+    n = _names(klass)
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    dropped = []
+    for year in partition_years(klass):
+        if year >= before:
+            break
+        part = qn(partition_name(n['table'], year))
+        cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (n['qtable'], part))
+        cursor.execute('DROP TABLE %s' % part)
+        dropped.append(year)
+    transaction.set_dirty()
+    logger.info('Dropped %s partitions: %s' % (n['table'], dropped))
+    return dropped
+
+
+@transaction.commit_on_success
+def create_covering_index(klass):
+    """
+    Index (date, product) including the columns of close and adj_close,
+    so cross sections of a date are read from the index alone. On a partitioned
+    table every partition, also later ones, gets it.
+    """
+    _check_vendor()
+    n = _names(klass)
+    cursor = connection.cursor()
+    cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s, %s) INCLUDE (%s)'
+                   % (connection.ops.quote_name(n['table'] + '_date_product_cover'),
+                      n['qtable'], n['date'], n['product'], n['include']))
+    transaction.set_dirty()
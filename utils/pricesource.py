@@ -0,0 +1,173 @@
+import io
+import os
+import socket
+import logging
+import tarfile
+import threading
+from os.path import join as pjoin
+from urllib.error import URLError
+
+from corpdb.utils import pullprice
+from corpdb.utils.metrics import metrics
+from corpdb.utils.pullprice import parse_price
+
+logger = logging.getLogger(__name__)
+
+
+class SourceError(Exception):
+    """
+    The source has no data for the request, e.g. a symbol missing from an
+    archive. Permanent: update_list fails the symbol without retrying.
+    """
+    pass
+
+
+# failures of a download, all but SourceError are worth a retry later
+SOURCE_ERRORS = (URLError, ConnectionResetError, socket.timeout, SourceError)
+
+
+class PriceSource(object):
+    """
+    Where update_single gets prices from.
+
+    Subclasses implement open(), returning the yahoo table.csv layout
+    (header row, then rows newest first) for dates in [startd, endd], as
+    a binary file object, a str or an iterable of text lines.
+    """
+
+    def open(self, symbol, startd=None, endd=None, period='d'):
+        raise NotImplementedError
+
+    def bars(self, symbol, startd=None, endd=None, period='d'):
+        """
+        Lazy iterator of typed bars, see parse_price.
+        """
+        return parse_price(self.open(symbol, startd=startd, endd=endd,
+                                     period=period))
+
+    def close(self):
+        pass
+
+
+class YahooSource(PriceSource):
+    """
+    ichart.finance.yahoo.com, or a server of the same API at `host`,
+    through the pooled client of pullprice.
+
+    With a ResponseCache `cache`, fresh cached bodies are served without
+    a request, stale ones are revalidated with their ETag/Last-Modified,
+    and other responses are read whole and stored.
+    """
+
+    def __init__(self, host=None, cache=None):
+        self.host = host
+        self.cache = cache
+
+    def open(self, symbol, startd=None, endd=None, period='d'):
+        if self.cache is None:
+            return pullprice.open_price(symbol, startd=startd, endd=endd,
+                                        period=period, host=self.host)
+
+        key = self.cache.key(self.host or pullprice.HOST, symbol, period,
+                             startd, endd)
+        entry = self.cache.get(key)
+        if entry is not None and entry[1]['fresh']:
+            metrics.inc('cache_hits')
+            return io.BytesIO(entry[0])
+
+        headers = self.cache.validators(entry[1]) if entry else None
+        response = pullprice.open_price(symbol, startd=startd, endd=endd,
+                                        period=period, host=self.host,
+                                        headers=headers)
+        try:
+            if response.status == 304 and entry is not None:
+                metrics.inc('cache_revalidated')
+                self.cache.touch(key)
+                return io.BytesIO(entry[0])
+            body = response.read()
+        finally:
+            response.close()
+        metrics.inc('cache_misses')
+        metrics.inc('bytes_downloaded', len(body))
+        self.cache.put(key, body, response.headers)
+        return io.BytesIO(body)
+
+
+class FileSource(PriceSource):
+    """
+    Replay mirrored csv files, one per symbol and period, laid out as
+    <period>/<symbol>.csv (e.g. d/000001.SZ.csv) under a directory or
+    inside a tarball. Rows are filtered to the requested dates the way the
+    yahoo server does it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._tar = None
+        self._members = None
+        self._lock = threading.Lock()
+        if os.path.isfile(root):
+            self._tar = tarfile.open(root)
+            self._members = {}
+            for m in self._tar.getmembers():
+                if m.isfile() and m.name.endswith('.csv'):
+                    # tolerate a top level directory in the tarball
+                    key = '/'.join(m.name.split('/')[-2:])
+                    self._members[key] = m
+
+    def _lines(self, symbol, period):
+        name = '%s/%s.csv' % (period, symbol)
+        if self._tar is None:
+            try:
+                return open(pjoin(self.root, period, symbol + '.csv'),
+                            'r', encoding='utf-8')
+            except FileNotFoundError:
+                raise SourceError('%s not found in %s' % (name, self.root))
+
+        member = self._members.get(name)
+        if member is None:
+            raise SourceError('%s not found in %s' % (name, self.root))
+        # tarfile is not thread safe, read the member in one go
+        with self._lock:
+            data = self._tar.extractfile(member).read()
+        return io.StringIO(data.decode('utf-8'))
+
+    def open(self, symbol, startd=None, endd=None, period='d'):
+        lines = self._lines(symbol, period)
+        start = startd.isoformat() if startd else None
+        end = endd.isoformat() if endd else None
+        return _filter_dates(lines, start, end)
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+
+
+def _filter_dates(lines, start, end):
+    try:
+        yield next(lines, '')
+        for line in lines:
+            d = line[:10]
+            if (start and d < start) or (end and d > end):
+                continue
+            yield line
+    finally:
+        lines.close()
+
+
+def get_source(spec='yahoo', cache=None):
+    """
+    Build a source from a command line value: 'yahoo', 'yahoo:host[:port]'
+    for a server of the yahoo API elsewhere, or the path of a directory or
+    tarball of mirrored csv files, optionally prefixed by 'file:'.
+    Downloads go through the ResponseCache `cache`, if given.
+    """
+    if not spec or spec == 'yahoo':
+        return YahooSource(cache=cache)
+    if spec.startswith('yahoo:'):
+        return YahooSource(host=spec[len('yahoo:'):], cache=cache)
+    if spec.startswith('file:'):
+        spec = spec[len('file:'):]
+    if not os.path.exists(spec):
+        raise ValueError('Unknown price source "%s"' % spec)
+    return FileSource(spec)
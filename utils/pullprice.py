@@ -1,16 +1,68 @@
+import io
 import socket
 import logging
+import threading
+import time
 import urllib.parse
-import urllib.request
+from datetime import date
 from urllib.error import URLError
 
-# timeout in seconds
+from corpdb.utils.httpclient import HttpClient
+from corpdb.utils.metrics import metrics
+
+# timeout in seconds, per request
 timeout = 6
-socket.setdefaulttimeout(timeout)
+# where prices are downloaded from, host[:port]
+HOST = 'ichart.finance.yahoo.com'
 logger = logging.getLogger(__name__)
 
 
-def pull_price(symbol, startd=None, endd=None, period='d'):
+class RateLimiter(object):
+    """
+    Thread safe limiter allowing at most `rate` requests per second to
+    each host. A rate of 0 or None disables limiting.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = {}
+
+    def wait(self, host):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            at = max(now, self._next.get(host, now))
+            self._next[host] = at + 1.0 / self.rate
+        if at > now:
+            time.sleep(at - now)
+
+
+rate_limiter = RateLimiter()
+# keep-alive connections shared by all downloads of the process
+client = HttpClient(timeout=timeout)
+
+
+def pull_price(symbol, startd=None, endd=None, period='d', host=None):
+    response = open_price(symbol, startd=startd, endd=endd, period=period,
+                          host=host)
+    try:
+        return response.read().decode()
+    except (URLError, ConnectionResetError, socket.timeout) as e:
+        logger.debug(str(e.__class__) + str(e))
+        raise e
+    finally:
+        response.close()
+
+
+def open_price(symbol, startd=None, endd=None, period='d', host=None,
+               headers=None):
+    """
+    Request the price csv from `host`, HOST by default, and return the
+    open response. The caller reads and closes it, see parse_price.
+    `headers` are sent along, e.g. for conditional requests.
+    """
     values = {}
     values['s'] = symbol
     if startd:
@@ -24,19 +76,70 @@ def pull_price(symbol, startd=None, endd=None, period='d'):
     values['g'] = period
     values['ignore'] = '.csv'
 
-    url = r'http://ichart.finance.yahoo.com/table.csv'
+    host = host or HOST
+    url = r'http://%s/table.csv' % host
     data = urllib.parse.urlencode(values)
     # usr_agent='Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; .NET CLR 1.1.4322)'
     # header={'User-Agent':usr_agent}
-    # req = urllib.request.Request(url+'?'+data, headers=header)
-    req = urllib.request.Request(url + '?' + data)
-    # req = urllib.request.Request('http://ichart.finance.yahoo.com/table.csv?g=m&s=600000.SS')
+    # client.get(url + '?' + data, headers=header)
+    full_url = url + '?' + data
+    # 'http://ichart.finance.yahoo.com/table.csv?g=m&s=600000.SS'
+    rate_limiter.wait(host)
+    metrics.inc('requests')
     try:
-        response = urllib.request.urlopen(req)
-        content = response.read().decode()
-        response.close()
-        return content
+        with metrics.timer('request_seconds'):
+            return client.get(full_url, headers=headers, timeout=timeout)
     except (URLError, ConnectionResetError, socket.timeout) as e:
+        metrics.inc('request_errors')
         logger.debug(str(e.__class__) + str(e))
-        logger.debug(req.full_url)
-        raise e
\ No newline at end of file
+        logger.debug(full_url)
+        raise e
+
+
+def parse_price(stream):
+    """
+    Yield (date, open, high, low, close, volume, adj_close) tuples with
+    typed values from a yahoo csv, newest first as the source sends them.
+
+    `stream` is a binary file object such as an http response, a str, or
+    an iterable of text lines. Lines are parsed one at a time; the header,
+    the latest row and the oldest row (the one on the requested start
+    date) are skipped, the same as the old splitlines()[2:-1] slicing.
+    The stream is closed when the generator finishes.
+
+    The time spent converting rows, not waiting for them, is recorded in
+    the parse_seconds metric, and the bytes of http responses in
+    bytes_downloaded.
+    """
+    if isinstance(stream, str):
+        lines = io.StringIO(stream.strip())
+    elif isinstance(stream, io.TextIOBase) or not hasattr(stream, 'read'):
+        lines = iter(stream)
+    else:
+        lines = io.TextIOWrapper(stream, encoding='utf-8')
+    clock = time.perf_counter
+    spent = 0.0
+    try:
+        next(lines, None)  # header
+        next(lines, None)  # latest, may be incomplete
+        held = None
+        for line in lines:
+            started = clock()
+            line = line.strip()
+            if not line:
+                continue
+            if held is not None:
+                spent += clock() - started
+                yield held
+                started = clock()
+            d, o, h, l, c, v, a = line.split(',')
+            held = (date(int(d[0:4]), int(d[5:7]), int(d[8:10])),
+                    float(o), float(h), float(l), float(c), int(v), float(a))
+            spent += clock() - started
+        # held is the oldest row, already stored by the previous run
+    finally:
+        if hasattr(lines, 'close'):
+            lines.close()
+        metrics.observe('parse_seconds', spent)
+        if hasattr(stream, 'bytes_read'):
+            metrics.inc('bytes_downloaded', stream.bytes_read)
\ No newline at end of file
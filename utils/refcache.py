@@ -0,0 +1,116 @@
+import logging
+import threading
+
+from django.db.models.signals import post_save, post_delete
+
+from corpdb.models import Exchange, Sector, Country, District
+
+logger = logging.getLogger(__name__)
+
+
+class RefRegistry(object):
+    """
+    In process cache of the small reference tables: exchanges, sectors,
+    countries and districts. Each table is loaded in one query on first
+    use and dropped whenever one of its rows is saved or deleted through
+    the ORM in this process. Other processes, raw SQL and bulk_create do
+    not send signals; call clear() after those.
+    """
+
+    models = (Exchange, Sector, Country, District)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def clear(self):
+        with self._lock:
+            self._tables = {}
+
+    def invalidate(self, model):
+        with self._lock:
+            self._tables.pop(model, None)
+
+    def _table(self, model):
+        table = self._tables.get(model)
+        if table is None:
+            table = self._load(model)
+            with self._lock:
+                self._tables[model] = table
+        return table
+
+    def _load(self, model):
+        rows = list(model.objects.all())
+        table = {'pk': {r.pk: r for r in rows}, 'key': {}, 'prefix': {}}
+        for r in rows:
+            if model is Country:
+                table['key'][r.iso] = r
+            elif model is District:
+                for i in range(1, len(r.name) + 1):
+                    table['prefix'].setdefault(
+                        (r.parent_id, r.name[:i]), []).append(r)
+                table['key'][(r.name, r.parent_id)] = r
+            else:
+                table['key'][(r.symbol if model is Exchange else r.code,
+                              r.parent_id)] = r
+        logger.debug('Loaded %d %s.' % (len(rows), model.__name__))
+        return table
+
+    def _lookup(self, model, key):
+        try:
+            return self._table(model)['key'][key]
+        except KeyError:
+            raise model.DoesNotExist('%s %s not found.' % (model.__name__, key))
+
+    def get(self, model, pk):
+        try:
+            return self._table(model)['pk'][pk]
+        except KeyError:
+            raise model.DoesNotExist('%s %s not found.' % (model.__name__, pk))
+
+    def exchange(self, symbol, parent=None):
+        return self._lookup(Exchange, (symbol, _pk(parent)))
+
+    def sector(self, code, parent=None):
+        return self._lookup(Sector, (code, _pk(parent)))
+
+    def country(self, iso):
+        return self._lookup(Country, iso)
+
+    def district(self, name, parent=None):
+        return self._lookup(District, (name, _pk(parent)))
+
+    def district_startswith(self, prefix, parent=None):
+        """
+        The district under `parent` whose name starts with `prefix`, like
+        District.objects.get(name__startswith=prefix, parent=parent).
+        """
+        found = self._table(District)['prefix'].get((_pk(parent), prefix), [])
+        if not found:
+            raise District.DoesNotExist('District %s not found.' % prefix)
+        if len(found) > 1:
+            raise District.MultipleObjectsReturned(
+                'District %s is ambiguous.' % prefix)
+        return found[0]
+
+    def children(self, obj):
+        return [r for r in self._table(type(obj))['pk'].values()
+                if r.parent_id == obj.pk]
+
+
+def _pk(obj):
+    return obj if obj is None or isinstance(obj, int) else obj.pk
+
+
+registry = RefRegistry()
+
+
+def _invalidate(sender, **kwargs):
+    registry.invalidate(sender)
+
+
+for _model in RefRegistry.models:
+    post_save.connect(_invalidate, sender=_model,
+                      dispatch_uid='corpdb.refcache.%s.save' % _model.__name__)
+    post_delete.connect(_invalidate, sender=_model,
+                        dispatch_uid='corpdb.refcache.%s.delete' % _model.__name__)
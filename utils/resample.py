@@ -0,0 +1,138 @@
+import logging
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+
+from corpdb.models import Product, OhlcStatus, OHLC_MODELS
+from corpdb.utils.codec import get_codec
+from corpdb.utils.saveprice import upsert_bars, touch_status, seed_status, BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# yahoo weekly and monthly volumes are average daily volumes
+AGGREGATE = {
+    'date': 'first',
+    'open': 'first',
+    'high': 'max',
+    'low': 'min',
+    'close': 'last',
+    'volume': 'mean',
+    'adj_close': 'last',
+}
+COLUMNS = ['product', 'date', 'open', 'high', 'low', 'close', 'volume',
+           'adj_close']
+
+
+def period_start(d, period):
+    """
+    First calendar day of the week (Monday) or month containing `d`.
+    """
+    if period == 'w':
+        return d - timedelta(d.weekday())
+    if period == 'm':
+        return d.replace(day=1)
+    raise ValueError('Can only resample to w or m, got "%s"' % period)
+
+
+def period_keys(dates, period):
+    """
+    Integer week or month number of each date, vectorized.
+    """
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    if period == 'w':
+        # 1970-01-01 is a Thursday, shift so weeks start on Monday
+        return (dates.astype('int64') + 3) // 7
+    return dates.astype('datetime64[M]').astype('int64')
+
+
+def aggregate(daily, period):
+    """
+    Resample a DataFrame of daily bars with COLUMNS into weekly or
+    monthly bars, one per product and period, labelled with the first
+    trading day of the period like yahoo does.
+    """
+    daily = daily.sort_values(['product', 'date'])
+    daily['key'] = period_keys(daily['date'].values, period)
+    bars = daily.groupby(['product', 'key'], sort=False).agg(AGGREGATE)
+    bars['volume'] = bars['volume'].round().astype('int64')
+    return bars.reset_index()
+
+
+def stale_products(period):
+    """
+    Ids of products with daily bars newer than the ones their `period`
+    bars were last resampled from, with the date to resample from: the
+    start of the week or month of the last `period` bar, or None for a
+    full history.
+    """
+    seed_status(OHLC_MODELS['d'], 'd')
+    seed_status(OHLC_MODELS[period], period)
+    daily = dict(OhlcStatus.objects.filter(period='d', last_date__isnull=False)
+                 .values_list('product', 'last_date'))
+    marks = dict((pk, (last, source)) for pk, last, source in
+                 OhlcStatus.objects.filter(period=period)
+                 .values_list('product', 'last_date', 'source_date'))
+    stale = {}
+    for pk, last in daily.items():
+        mark, source = marks.get(pk, (None, None))
+        if mark is None:
+            stale[pk] = None
+        elif source is None or last > source:
+            # downloaded bars, or resampled before source_date existed,
+            # have no source date
+            stale[pk] = period_start(mark, period)
+    return stale
+
+
+def resample(klass, period, products=None, chunk=200, batch_size=BATCH_SIZE):
+    """
+    Build or refresh the `period` bars in the table of `klass` from
+    the daily ones. Only products in `products` (a dict of id to start date as
+    returned by stale_products, the default) are touched, `chunk` of
+    them per query.
+
+    Returns the number of bars written.
+    """
+    if products is None:
+        products = stale_products(period)
+    ids = sorted(products)
+    count = 0
+    for i in range(0, len(ids), chunk):
+        count += _resample_chunk(klass, period,
+                                 {pk: products[pk] for pk in ids[i:i + chunk]},
+                                 batch_size)
+    logger.info('Resampled %d %s bars of %d products.' % (count, period, len(ids)))
+    return count
+
+
+@transaction.commit_on_success
+def _resample_chunk(klass, period, products, batch_size):
+    starts = [d for d in products.values() if d is not None]
+    codec = get_codec(OHLC_MODELS['d'])
+    rows = OHLC_MODELS['d'].objects.filter(product__in=list(products))
+    if starts and len(starts) == len(products):
+        rows = rows.filter(date__gte=min(starts))
+    rows = rows.values_list('product', *codec.fields)
+    daily = pd.DataFrame.from_records(
+        [r[:1] + codec.decode(r[1:]) for r in rows.iterator()], columns=COLUMNS)
+    if daily.empty:
+        return 0
+
+    # drop days before each product's own start
+    start = daily['product'].map({pk: d or date.min
+                                  for pk, d in products.items()})
+    daily = daily[daily['date'] >= start]
+
+    covered = daily.groupby('product')['date'].max().to_dict()
+    bars = aggregate(daily, period)
+    objs = Product.objects.in_bulk(list(products))
+    count = 0
+    for pk, group in bars.groupby('product', sort=False):
+        product = objs[pk]
+        rows = list(zip(*[group[c].tolist() for c in COLUMNS[1:]]))
+        count += upsert_bars(klass, product, rows, batch_size=batch_size)
+        touch_status(product, period, last_date=max(r[0] for r in rows),
+                     source_date=covered[pk])
+    return count
@@ -0,0 +1,144 @@
+import os
+import json
+import gzip
+import time
+import hashlib
+import logging
+import threading
+from os.path import join as pjoin
+
+logger = logging.getLogger(__name__)
+
+# entries younger than this are used without asking the server, seconds
+TTL = 12 * 60 * 60
+# total size of the cache directory before old entries are dropped
+MAX_BYTES = 512 * 2 ** 20
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of price responses. Each entry is the gzipped body in
+    <root>/<xx>/<key>.gz and its ETag, Last-Modified and store time in
+    <key>.json, both written atomically.
+
+    Entries younger than `ttl` seconds are fresh. Older ones are kept for
+    revalidation when they have a validator. Once the directory grows
+    over `max_bytes`, the least recently stored entries are dropped.
+    Safe to share between threads and processes.
+    """
+
+    def __init__(self, root, ttl=TTL, max_bytes=MAX_BYTES):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._size = sum(size for path, size, mtime in self._files())
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest()
+
+    def _path(self, key, ext):
+        return pjoin(self.root, key[:2], key + ext)
+
+    def _files(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                path = pjoin(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def get(self, key):
+        """
+        Return (body, meta) of the entry, or None. meta['fresh'] tells
+        whether it is younger than the ttl.
+        """
+        try:
+            with open(self._path(key, '.json'), 'r') as f:
+                meta = json.load(f)
+            with gzip.open(self._path(key, '.gz'), 'rb') as f:
+                body = f.read()
+        except (IOError, ValueError, EOFError):
+            return None
+        meta['fresh'] = time.time() - meta['stored'] < self.ttl
+        return body, meta
+
+    def validators(self, meta):
+        """
+        Conditional request headers for an entry.
+        """
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def _write(self, path, data):
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return len(data)
+
+    def put(self, key, body, headers=None):
+        """
+        Store `body` with the validators of the response `headers`.
+        """
+        headers = headers or {}
+        meta = {'stored': time.time(),
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')}
+        os.makedirs(pjoin(self.root, key[:2]), exist_ok=True)
+        size = self._write(self._path(key, '.gz'), gzip.compress(body))
+        size += self._write(self._path(key, '.json'), json.dumps(meta).encode())
+        with self._lock:
+            self._size += size
+            full = self._size > self.max_bytes
+        if full:
+            self.evict()
+
+    def touch(self, key):
+        """
+        Mark an entry fresh again after the server confirmed it.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return
+        meta = entry[1]
+        meta.pop('fresh')
+        meta['stored'] = time.time()
+        self._write(self._path(key, '.json'), json.dumps(meta).encode())
+
+    def evict(self):
+        """
+        Drop entries, oldest first, until the cache holds 90% of
+        max_bytes at most.
+        """
+        with self._lock:
+            # the body and meta of an entry go together
+            entries = {}
+            for path, fsize, mtime in self._files():
+                paths, esize, emtime = entries.get(os.path.splitext(path)[0],
+                                                   ([], 0, 0))
+                entries[os.path.splitext(path)[0]] = (
+                    paths + [path], esize + fsize, max(emtime, mtime))
+            size = sum(e[1] for e in entries.values())
+            target = self.max_bytes * 0.9
+            removed = 0
+            for paths, esize, mtime in sorted(entries.values(), key=lambda e: e[2]):
+                if size <= target:
+                    break
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                size -= esize
+                removed += 1
+            self._size = size
+        logger.debug('Evicted %d cache entries from %s.' % (removed, self.root))
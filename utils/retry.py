@@ -0,0 +1,90 @@
+import heapq
+import random
+import time
+from itertools import count
+
+
+class Backoff(object):
+    """
+    Jittered exponential backoff: attempt n waits a random time between
+    half and all of min(cap, base * 2 ** n) seconds.
+    """
+
+    def __init__(self, base=3, cap=60 * 2):
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        d = min(self.cap, self.base * 2 ** attempt)
+        return d * random.uniform(0.5, 1)
+
+
+class RetryQueue(object):
+    """
+    Priority queue of (next_attempt_time, item), earliest first. Items
+    carry the number of attempts already made.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, delay=0, attempts=0):
+        heapq.heappush(self._heap,
+                       (time.time() + delay, next(self._seq), item, attempts))
+
+    def wait_time(self):
+        """
+        Seconds until the earliest item is due, 0 if one is due already.
+        """
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - time.time())
+
+    def ready(self):
+        return bool(self._heap) and self._heap[0][0] <= time.time()
+
+    def pop(self):
+        """
+        Return (item, attempts) of the earliest item.
+        """
+        at, seq, item, attempts = heapq.heappop(self._heap)
+        return item, attempts
+
+    def items(self):
+        return [entry[2] for entry in self._heap]
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` consecutive failures and blocks new attempts
+    for `cooldown` seconds. After the cooldown one failure is enough to
+    open it again, a success closes it.
+    """
+
+    def __init__(self, threshold=10, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+
+    def wait_time(self):
+        return max(0, self.open_until - time.time())
+
+    def closed(self):
+        return self.wait_time() == 0
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.time() + self.cooldown
+            # half open: next failure trips it again
+            self.failures = self.threshold - 1
+            return True
+        return False
@@ -0,0 +1,184 @@
+import logging
+from datetime import datetime
+from itertools import islice
+
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from corpdb.models import Product, OhlcStatus
+from corpdb.utils.codec import get_codec
+
+logger = logging.getLogger(__name__)
+
+# rows per INSERT statement
+BATCH_SIZE = 500
+
+UPSERT_SQL = {
+    'postgresql': ('INSERT INTO {table} ({columns}) VALUES {values} '
+                   'ON CONFLICT ({product}, {date}) DO UPDATE SET {updates}'),
+    'sqlite': 'INSERT OR REPLACE INTO {table} ({columns}) VALUES {values}',
+    'mysql': ('INSERT INTO {table} ({columns}) VALUES {values} '
+              'ON DUPLICATE KEY UPDATE {updates}'),
+}
+UPDATE_SQL = {
+    'postgresql': '{col} = EXCLUDED.{col}',
+    'mysql': '{col} = VALUES({col})',
+}
+
+
+def save_bars(klass, product, bars, batch_size=BATCH_SIZE):
+    """
+    Insert bars of `product` into the ohlc table of `klass` with one
+    statement per `batch_size` rows.
+
+    `bars` is any iterable of rows in the column order of the yahoo csv:
+    (date, open, high, low, close, volume, adj_close), stored as the codec
+    of `klass` says. It is consumed lazily, so at most one batch of model
+    instances is alive at a time.
+
+    Returns the number of rows inserted.
+    """
+    fields = get_codec(klass).fields
+    encode = get_codec(klass).encode
+    bars = iter(bars)
+    count = 0
+    while True:
+        objs = [klass(product=product, **dict(zip(fields, encode(b))))
+                for b in islice(bars, batch_size)]
+        if not objs:
+            break
+        klass.objects.bulk_create(objs)
+        count += len(objs)
+    return count
+
+
+def upsert_bars(klass, product, bars, batch_size=BATCH_SIZE):
+    """
+    Like save_bars, but rows whose (product, date) already exist are
+    overwritten instead of duplicated, so overlapping reruns are safe.
+
+    Uses ON CONFLICT on PostgreSQL, INSERT OR REPLACE on SQLite and
+    ON DUPLICATE KEY UPDATE on MySQL. Other backends delete the dates of
+    each batch before inserting it.
+
+    Returns the number of rows written.
+    """
+    template = UPSERT_SQL.get(connection.vendor)
+    if template is None:
+        return _replace_bars(klass, product, bars, batch_size)
+
+    qn = connection.ops.quote_name
+    codec = get_codec(klass)
+    fields = [klass._meta.get_field(f) for f in codec.fields]
+    columns = [qn(klass._meta.get_field('product').column)]
+    columns += [qn(f.column) for f in fields]
+    update = UPDATE_SQL.get(connection.vendor, '')
+    sql = template.format(
+        table=qn(klass._meta.db_table),
+        columns=', '.join(columns),
+        product=columns[0],
+        date=columns[1],
+        updates=', '.join(update.format(col=c) for c in columns[2:]),
+        values='{values}',
+    )
+    row_sql = '(%s)' % ', '.join(['%s'] * len(columns))
+    batch_size = min(batch_size,
+                     connection.ops.bulk_batch_size(columns, [None] * batch_size))
+
+    bars = iter(bars)
+    count = 0
+    cursor = connection.cursor()
+    while True:
+        params = []
+        n = 0
+        for b in islice(bars, batch_size):
+            params.append(product.pk)
+            params.extend(f.get_db_prep_save(v, connection)
+                          for f, v in zip(fields, codec.encode(b)))
+            n += 1
+        if not n:
+            break
+        cursor.execute(sql.format(values=', '.join([row_sql] * n)), params)
+        count += n
+    transaction.set_dirty()
+    return count
+
+
+def _replace_bars(klass, product, bars, batch_size):
+    bars = iter(bars)
+    count = 0
+    while True:
+        batch = list(islice(bars, batch_size))
+        if not batch:
+            break
+        klass.objects.filter(product=product,
+                             date__in=[b[0] for b in batch]).delete()
+        count += save_bars(klass, product, batch, batch_size=batch_size)
+    return count
+
+
+def touch_status(product, period, last_date=None, error='', source_date=None):
+    """
+    Record a download attempt in the ohlc_status watermark. `last_date`
+    is the newest bar just written, if any, and `source_date` the newest
+    daily bar it was resampled from; the stored dates never move
+    backwards.
+    """
+    if isinstance(last_date, str):
+        last_date = datetime.strptime(last_date, '%Y-%m-%d').date()
+    status, created = OhlcStatus.objects.get_or_create(product=product,
+                                                       period=period)
+    status.last_attempt = timezone.now()
+    status.last_error = error
+    if last_date and (status.last_date is None or last_date > status.last_date):
+        status.last_date = last_date
+    if source_date and (status.source_date is None or
+                        source_date > status.source_date):
+        status.source_date = source_date
+    status.save()
+    return status
+
+
+@transaction.commit_on_success
+def rebuild_status(klass, period):
+    """
+    Recompute the watermarks of `period` from the ohlc table of `klass`.
+    This is a full scan and only needed once, or after bars were written
+    by other means than the loader.
+    """
+    OhlcStatus.objects.filter(period=period).delete()
+    marks = klass.objects.values_list('product').annotate(last=Max('date'))
+    OhlcStatus.objects.bulk_create(
+        [OhlcStatus(product_id=pk, period=period, last_date=last)
+         for pk, last in marks.iterator()],
+        batch_size=BATCH_SIZE)
+    logger.info('Rebuilt %s ohlc status.' % period)
+
+
+@transaction.commit_on_success
+def seed_status(klass, period):
+    """
+    Create the missing watermarks of `period`: products with bars in the
+    table of `klass` but no ohlc_status row get their newest bar date, so
+    they are not downloaded again from the start. The products without a
+    row are listed first, and only their bars are read, through the
+    (product, date) index. Returns the number of watermarks created.
+    """
+    known = OhlcStatus.objects.filter(period=period).values('product')
+    missing = list(Product.objects.exclude(pk__in=known)
+                   .values_list('pk', flat=True))
+    if not missing:
+        return 0
+    marks = []
+    for i in range(0, len(missing), BATCH_SIZE):
+        marks.extend(klass.objects.filter(product__in=missing[i:i + BATCH_SIZE])
+                     .values_list('product').annotate(last=Max('date')))
+    created = OhlcStatus.objects.bulk_create(
+        [OhlcStatus(product_id=pk, period=period, last_date=last)
+         for pk, last in marks],
+        batch_size=BATCH_SIZE)
+    if created:
+        logger.info('Seeded %d %s ohlc status from the ohlc table.'
+                    % (len(created), period))
+    return len(created)